@@ -0,0 +1,5 @@
+import sys
+
+from pynesis.cli import main
+
+sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Host-local fan-out of a stream: a single SharedMemoryBroker process reads the stream from Kinesis and
+publishes its records into a ring buffer in shared memory, from which any number of local processes read
+with SharedMemorySubscriber. Requires Python 3.8 or later (multiprocessing.shared_memory).
+
+The broker checkpoints the stream once the records are published, and each subscriber has its own
+cursor and checkpointer. The ring buffer only keeps the most recent `size` bytes of records, so a
+subscriber falling further behind than that loses the records it did not read in time (see `overruns`).
+
+When the broker stops it marks the block as closed and destroys it, and a restarted broker creates a new
+one. Running subscribers keep reading the records left in the closed block, then attach to the new one,
+skipping the records they already checkpointed. As the broker checkpoints records once published, those
+left in the closed block are lost for the subscribers that were not running when it was destroyed.
+"""
+import logging
+import struct
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Generator, List, Optional, Tuple  # noqa
+
+from pynesis.checkpointers import Checkpointer, InMemoryCheckpointer  # noqa
+from pynesis.streams import KinesisRecord, KinesisStream, epoch_millis  # noqa
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = 0x70796e65736973  # "pynesis"
+# magic, capacity, reserved position, written position, oldest record position
+_HEADER = struct.Struct("<QQQQQ")
+# set once the broker stops publishing into the block
+_CLOSED = struct.Struct("<Q")
+_DATA_OFFSET = 64
+# frame size, arrival timestamp (epoch milliseconds), shard id size, sequence number size, partition key size
+_FRAME = struct.Struct("<IqHHH")
+_PADDING = 0xffffffff
+_ALIGNMENT = 8
+
+
+def _align(size):  # type: (int) -> int
+    return (size + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _attach(name):  # type: (str) -> Any
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # type: ignore
+    except TypeError:  # Before Python 3.13 attached memory is tracked, and destroyed when the process exits
+        from multiprocessing import resource_tracker
+
+        memory = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, "shared_memory")  # type: ignore
+        return memory
+
+
+class BrokerOverrunException(Exception):
+    pass
+
+
+class _RingBuffer(object):
+    """
+    Records ring buffer with a single writer and any number of readers.
+
+    Positions are byte counts since the buffer was created, so that readers can tell whether the writer has
+    gone past them: before writing a frame the writer publishes the "reserved" position, up to which the
+    buffer is about to be overwritten, and once it is written the "written" position, up to which frames
+    can be read. A reader copying a frame checks afterwards that the reserved position did not overtake it.
+    """
+    def __init__(self, buffer, capacity):  # type: (Any, int) -> None
+        self._buffer = buffer
+        self.capacity = capacity
+        self._frames = deque()  # type: Deque[int]
+
+    def header(self):  # type: () -> Tuple[int, int, int, int, int]
+        return _HEADER.unpack_from(self._buffer, 0)
+
+    def initialize(self):  # type: () -> None
+        _HEADER.pack_into(self._buffer, 0, _MAGIC, self.capacity, 0, 0, 0)
+        _CLOSED.pack_into(self._buffer, _HEADER.size, 0)
+
+    @property
+    def closed(self):  # type: () -> bool
+        return bool(_CLOSED.unpack_from(self._buffer, _HEADER.size)[0])
+
+    def close(self):  # type: () -> None
+        _CLOSED.pack_into(self._buffer, _HEADER.size, 1)
+
+    def write(self, shard_id, record):  # type: (str, KinesisRecord) -> None
+        shard_id_bytes = shard_id.encode("utf-8")
+        sequence_bytes = record.sequence_number.encode("utf-8")
+        key_bytes = (record.partition_key or "").encode("utf-8")
+        size = _FRAME.size + len(shard_id_bytes) + len(sequence_bytes) + len(key_bytes) + len(record.data)
+        if _align(size) > self.capacity:
+            raise ValueError("Record {} does not fit in the broker buffer".format(record.sequence_number))
+
+        position = self.header()[3]
+        offset = position % self.capacity
+        if offset + _align(size) > self.capacity:
+            self._reserve(position, self.capacity - offset)
+            struct.pack_into("<I", self._buffer, _DATA_OFFSET + offset, _PADDING)
+            position = self._publish(position + self.capacity - offset)
+            offset = 0
+
+        self._reserve(position, _align(size))
+        start = _DATA_OFFSET + offset
+        _FRAME.pack_into(self._buffer, start, size, epoch_millis(record.approximate_arrival_timestamp),
+                         len(shard_id_bytes), len(sequence_bytes), len(key_bytes))
+        self._buffer[start + _FRAME.size:start + size] = shard_id_bytes + sequence_bytes + key_bytes + record.data
+        self._publish(position + _align(size))
+
+    def read(self, position):  # type: (int) -> Tuple[Optional[Tuple[str, KinesisRecord]], int]
+        """
+        Returns the ((shard id, record), next position) of the record at `position`, or (None, position) if there
+        is none yet, raising BrokerOverrunException if the writer has overwritten it
+        """
+        while True:
+            magic, capacity, reserved, written, oldest = self.header()
+            if position >= written:
+                return None, position
+            offset = position % self.capacity
+            start = _DATA_OFFSET + offset
+            if struct.unpack_from("<I", self._buffer, start)[0] == _PADDING:
+                frame = None  # type: Optional[bytes]
+                size = self.capacity - offset
+            else:
+                size = _FRAME.unpack_from(self._buffer, start)[0]
+                frame = bytes(self._buffer[start:start + min(size, self.capacity - offset)])
+            if position < self.header()[2] - self.capacity:
+                raise BrokerOverrunException("Broker buffer overwritten at position {}".format(position))
+            if frame is None:
+                position += size
+                continue
+            return self._decode(frame), position + _align(size)
+
+    def _reserve(self, position, size):  # type: (int, int) -> None
+        end = position + size
+        self._frames.append(position)
+        while self._frames[0] < end - self.capacity:
+            self._frames.popleft()
+        magic, capacity, reserved, written, oldest = self.header()
+        _HEADER.pack_into(self._buffer, 0, magic, capacity, end, written, self._frames[0])
+
+    def _publish(self, position):  # type: (int) -> int
+        magic, capacity, reserved, written, oldest = self.header()
+        _HEADER.pack_into(self._buffer, 0, magic, capacity, reserved, position, oldest)
+        return position
+
+    @staticmethod
+    def _decode(frame):  # type: (bytes) -> Tuple[str, KinesisRecord]
+        size, arrival, shard_id_size, sequence_size, key_size = _FRAME.unpack_from(frame, 0)
+        position = _FRAME.size
+        shard_id = frame[position:position + shard_id_size].decode("utf-8")
+        position += shard_id_size
+        sequence_number = frame[position:position + sequence_size].decode("utf-8")
+        position += sequence_size
+        partition_key = frame[position:position + key_size].decode("utf-8")
+        position += key_size
+        return shard_id, KinesisRecord.build(
+            sequence_number=sequence_number,
+            approximate_arrival_timestamp=datetime(1970, 1, 1) + timedelta(milliseconds=arrival),
+            data=frame[position:size],
+            partition_key=partition_key,
+        )
+
+
+class SharedMemoryBroker(object):
+    """
+    Reads a stream and publishes its records into the shared memory block `name`, of `size` bytes,
+    for SharedMemorySubscriber instances to read them.
+    """
+    def __init__(self, stream, name, size=64 * 1024 * 1024):  # type: (KinesisStream, str, int) -> None
+        self._stream = stream
+        self._name = name
+        self._size = _align(size)
+        self._memory = None  # type: Any
+        self._ring = None  # type: Optional[_RingBuffer]
+
+    def start(self):  # type: () -> None
+        """
+        Creates the shared memory block, which is done by run() if it was not called before.
+        A block left behind by a broker that did not close it is closed and replaced.
+        """
+        from multiprocessing import shared_memory
+
+        try:
+            self._memory = shared_memory.SharedMemory(name=self._name, create=True, size=_DATA_OFFSET + self._size)
+        except FileExistsError:
+            logger.warning("Replacing the shared memory block {} left by a previous broker".format(self._name))
+            stale_memory = shared_memory.SharedMemory(name=self._name)  # type: Any
+            _RingBuffer(stale_memory.buf, _HEADER.unpack_from(stale_memory.buf, 0)[1]).close()
+            stale_memory.close()
+            stale_memory.unlink()
+            self._memory = shared_memory.SharedMemory(name=self._name, create=True, size=_DATA_OFFSET + self._size)
+        self._ring = _RingBuffer(self._memory.buf, self._size)
+        self._ring.initialize()
+
+    def stop(self):  # type: () -> None
+        self._stream.stop()
+
+    def publish(self, shard_id, records):  # type: (str, List[KinesisRecord]) -> None
+        assert self._ring is not None, "start() must be called first"
+        for record in records:
+            self._ring.write(shard_id, record)
+
+    def run(self):  # type: () -> None
+        """
+        Publishes the stream records until stop() is called, then destroys the shared memory block
+        """
+        if self._memory is None:
+            self.start()
+        try:
+            for shard_id, records, checkpoint_sequence in self._stream.read_shard_batches():
+                if records:
+                    self.publish(shard_id, records)
+                if checkpoint_sequence is not None:
+                    self._stream.checkpointer.checkpoint(shard_id, checkpoint_sequence)
+        finally:
+            self.close()
+
+    def close(self):  # type: () -> None
+        """
+        Marks the shared memory block as closed for the subscribers, and destroys it
+        """
+        if self._memory is not None:
+            if self._ring is not None:
+                self._ring.close()
+            self._ring = None
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+
+class SharedMemorySubscriber(object):
+    """
+    Reads the records published by the SharedMemoryBroker using the shared memory block `name`.
+
+    It starts from the oldest record still in the buffer, skipping those already checkpointed by its
+    `checkpointer`. When the broker overwrites records before they are read, they are counted in `overruns`
+    and reading continues from the oldest record still in the buffer. When the broker is restarted, the
+    subscriber attaches to the block of the new broker once it has read the records left in the old one.
+    """
+    def __init__(self, name, checkpointer=None, poll_interval=0.1):  # type: (str, Checkpointer, float) -> None
+        self._name = name
+        self._checkpointer = checkpointer if checkpointer is not None else InMemoryCheckpointer()
+        self._poll_interval = poll_interval
+        self._stop = False
+        self.overruns = 0
+
+    @property
+    def checkpointer(self):  # type: () -> Checkpointer
+        return self._checkpointer
+
+    def stop(self):  # type: () -> None
+        self._stop = True
+
+    def read(self):  # type: () -> Generator[KinesisRecord, None, None]
+        """
+        Yields the published records until stop() is called, checkpointing each one once the next is requested
+        """
+        memory = _attach(self._name)  # type: Any
+        try:
+            ring = _RingBuffer(memory.buf, _HEADER.unpack_from(memory.buf, 0)[1])
+            checkpoints = {shard_id: int(sequence)
+                           for shard_id, sequence in self._checkpointer.get_all_checkpoints().items()}
+            position = ring.header()[4]
+            while not self._stop:
+                if memory is None:
+                    memory = self._reattach()
+                    if memory is not None:
+                        ring = _RingBuffer(memory.buf, _HEADER.unpack_from(memory.buf, 0)[1])
+                        position = ring.header()[4]
+                    continue
+                try:
+                    entry, position = ring.read(position)
+                except BrokerOverrunException:
+                    self.overruns += 1
+                    position = ring.header()[4]
+                    logger.warning("Subscriber of {} fell behind the broker, records were lost".format(self._name))
+                    continue
+                if entry is None:
+                    if ring.closed:
+                        logger.info("The broker of {} was stopped, waiting for a new one".format(self._name))
+                        memory.close()
+                        memory = None
+                        continue
+                    time.sleep(self._poll_interval)
+                    continue
+
+                shard_id, record = entry
+                if int(record.sequence_number) <= checkpoints.get(shard_id, -1):
+                    continue
+                yield record
+                checkpoints[shard_id] = int(record.sequence_number)
+                self._checkpointer.checkpoint(shard_id, record.sequence_number)
+        finally:
+            self._checkpointer.flush()
+            if memory is not None:
+                memory.close()
+
+    def _reattach(self):  # type: () -> Any
+        try:
+            memory = _attach(self._name)
+        except FileNotFoundError:
+            time.sleep(self._poll_interval)
+            return None
+        if _RingBuffer(memory.buf, _HEADER.unpack_from(memory.buf, 0)[1]).closed:
+            memory.close()
+            time.sleep(self._poll_interval)
+            return None
+        return memory
@@ -1,4 +1,6 @@
 import abc
+import time
+from threading import Lock, Timer
 from typing import Optional, Dict  # noqa
 
 from six import with_metaclass
@@ -34,6 +36,11 @@ class Checkpointer(with_metaclass(abc.ABCMeta, object)):  # type: ignore
         values are the sequence id of the last record processed for its shard
         """
 
+    def flush(self):  # type: () -> None
+        """
+        Persist any checkpoint buffered by the implementation. Streams call it when they stop reading
+        """
+
 
 class InMemoryCheckpointer(Checkpointer):
     """
@@ -95,6 +102,78 @@ class RedisCheckpointer(InMemoryCheckpointer):
         self._checkpoints = self._redis_client.hgetall(self._key)
 
 
+class SQLiteCheckpointer(InMemoryCheckpointer):
+    """
+    A checkpointer storing positions in a local SQLite database, for consumers running in a single host.
+
+    Checkpoints are kept in memory and written together (a single transaction and fsync) `commit_interval`
+    seconds after the last commit, from a background timer if no other checkpoint comes by then, and when
+    flush() is called, which streams do when they stop reading. Checkpoints not yet committed when the
+    process crashes are lost, so at most `commit_interval` seconds of records would be processed again.
+
+    Several streams may share the same database file as long as each checkpointer uses its own `key`.
+    """
+    def __init__(self,
+                 path="pynesis-checkpoints.db",  # type: str
+                 key="kinesis:sequences",  # type: str
+                 commit_interval=1,  # type: float
+                 ):  # type: (...)->None
+        import sqlite3
+
+        super(SQLiteCheckpointer, self).__init__()
+        self._key = key
+        self._commit_interval = commit_interval
+        self._pending = {}  # type: Dict[str, str]
+        self._last_commit = time.time()
+        self._lock = Lock()
+        self._timer = None  # type: Optional[Timer]
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pynesis_checkpoints "
+                                     "(key TEXT, shard_id TEXT, sequence TEXT, PRIMARY KEY (key, shard_id))")
+        self._load_checkpoints()
+
+    def checkpoint(self, shard_id, sequence):  # type: (str, str) -> None
+        with self._lock:
+            super(SQLiteCheckpointer, self).checkpoint(shard_id, sequence)
+            self._pending[shard_id] = sequence
+            elapsed = time.time() - self._last_commit
+            if elapsed >= self._commit_interval:
+                self._commit()
+            elif self._timer is None:
+                self._timer = Timer(self._commit_interval - elapsed, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):  # type: () -> None
+        with self._lock:
+            self._commit()
+
+    def close(self):  # type: () -> None
+        self.flush()
+        self._connection.close()
+
+    def _commit(self):  # type: () -> None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO pynesis_checkpoints (key, shard_id, sequence) VALUES (?, ?, ?)",
+                    [(self._key, shard_id, sequence) for shard_id, sequence in self._pending.items()])
+            self._pending = {}
+        self._last_commit = time.time()
+
+    def _load_checkpoints(self):  # type: () -> None
+        rows = self._connection.execute("SELECT shard_id, sequence FROM pynesis_checkpoints WHERE key = ?",
+                                        (self._key,))
+        self._checkpoints = dict(rows)
+
+
 class DynamoCheckpointer(Checkpointer):
     """
     DynamoDB based checkpointer implementation.
@@ -0,0 +1,297 @@
+"""
+Command line tool for loading, dumping and tailing Kinesis streams, run it with `python -m pynesis --help`.
+
+Records are read and written as JSON lines:
+
+ - `dump` writes a file per shard, where each line has the "shard_id", "sequence_number",
+   "partition_key", "approximate_arrival_timestamp" and "data" (base64 encoded) of a record.
+ - `put` loads those same lines, or any other JSON lines, which are then used as record data
+   with the partition key taken from the `--key-field` field (or a random one).
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from threading import Event, Lock, Thread
+from typing import Any, Dict, IO, Iterable, List, Optional, Tuple  # noqa
+
+from six.moves.queue import Empty, Queue
+
+from pynesis.streams import KinesisRecord, KinesisStream, ShardIterators  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+class ThroughputReporter(object):
+    """
+    Counts records and bytes, periodically writing the totals and rates to `output`
+    """
+    def __init__(self, output=None, interval=1):  # type: (IO[str], float) -> None
+        self._output = output or sys.stderr
+        self._interval = interval
+        self._lock = Lock()
+        self._records = 0
+        self._bytes = 0
+        self._start_time = time.time()
+        self._stopped = Event()
+        self._thread = None  # type: Optional[Thread]
+
+    def add(self, records, size):  # type: (int, int) -> None
+        with self._lock:
+            self._records += records
+            self._bytes += size
+
+    def start(self):  # type: () -> None
+        self._start_time = time.time()
+        self._thread = Thread(target=self._report_periodically, name="pynesis-throughput")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):  # type: () -> None
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+    def report(self):  # type: () -> None
+        with self._lock:
+            records, size = self._records, self._bytes
+        elapsed = max(time.time() - self._start_time, 1e-6)
+        self._output.write("{} records ({:.1f} records/s), {} bytes ({:.1f} bytes/s)\n".format(
+            records, records / elapsed, size, size / elapsed))
+        self._output.flush()
+
+    def _report_periodically(self):  # type: () -> None
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+
+def record_to_json(shard_id, record):  # type: (str, KinesisRecord) -> str
+    timestamp = record.approximate_arrival_timestamp
+    return json.dumps({
+        "shard_id": shard_id,
+        "sequence_number": record.sequence_number,
+        "partition_key": record.partition_key,
+        "approximate_arrival_timestamp": timestamp.isoformat() if timestamp is not None else None,
+        "data": base64.b64encode(record.data).decode("ascii"),
+    }, sort_keys=True)
+
+
+def json_to_record(line, key_field=None):  # type: (str, str) -> Tuple[str, bytes]
+    """
+    Returns the (key, data) to put for a line, see the module documentation for the supported formats
+    """
+    document = json.loads(line)
+    if isinstance(document, dict) and "partition_key" in document and "data" in document:
+        return document["partition_key"], base64.b64decode(document["data"])
+
+    key = None
+    if key_field is not None and isinstance(document, dict):
+        key = document.get(key_field)
+    return str(key if key is not None else uuid.uuid4()), line.encode("utf-8")
+
+
+def parse_timestamp(value):  # type: (str) -> datetime
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def put(stream, lines, key_field=None, batch_size=500, concurrency=4, retries=3,
+        reporter=None):  # type: (KinesisStream, Iterable[str], str, int, int, int, ThroughputReporter) -> int
+    """
+    Puts the records of the given lines using `concurrency` threads doing PutRecords calls of `batch_size`
+    records, retrying `retries` times the records rejected by Kinesis (or all the records of a batch when
+    the call fails). Returns the number of records that could not be put.
+    """
+    batches = Queue(maxsize=concurrency * 2)  # type: Queue
+    failures = []  # type: List[int]
+
+    def work():  # type: () -> None
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            for attempt in range(retries + 1):
+                try:
+                    failed = stream.put_records(batch)
+                except Exception:
+                    logger.exception("Error putting {} records".format(len(batch)))
+                    failed = batch
+                failed_records = set(id(record) for record in failed)
+                put_records = [record for record in batch if id(record) not in failed_records]
+                if reporter is not None:
+                    reporter.add(len(put_records), sum(len(data) for key, data in put_records))
+                batch = failed
+                if not batch:
+                    break
+                time.sleep(0.1 * 2 ** attempt)
+            if batch:
+                failures.append(len(batch))
+
+    workers = [Thread(target=work, name="pynesis-put-{}".format(i)) for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+
+    batch = []  # type: List[Tuple[str, bytes]]
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(json_to_record(line, key_field))
+        if len(batch) == batch_size:
+            batches.put(batch)
+            batch = []
+    if batch:
+        batches.put(batch)
+
+    for _ in workers:
+        batches.put(None)
+    for worker in workers:
+        worker.join()
+    return sum(failures)
+
+
+def dump(stream, directory, concurrency=None, reporter=None):
+    # type: (KinesisStream, str, int, ThroughputReporter) -> List[str]
+    """
+    Writes the records of every shard into `<directory>/<shard id>.jsonl`, reading the shards in
+    parallel (up to `concurrency` at a time) until each of them has been read up to its tip.
+    Returns the ids of the shards that could not be dumped.
+    """
+    shard_iterators = ShardIterators(stream)
+    shard_iterators.update()
+    shards = Queue()  # type: Queue
+    for shard_id in shard_iterators.shard_ids():
+        shards.put(shard_id)
+    failed_shards = []  # type: List[str]
+
+    def work():  # type: () -> None
+        while True:
+            try:
+                shard_id = shards.get_nowait()
+            except Empty:
+                return
+            try:
+                dump_shard(shard_id)
+            except Exception:
+                logger.exception("Error dumping shard {}".format(shard_id))
+                failed_shards.append(shard_id)
+
+    def dump_shard(shard_id):  # type: (str) -> None
+        with open(os.path.join(directory, "{}.jsonl".format(shard_id)), "w") as output:
+            while not stream.stopped:
+                records = shard_iterators.get_records(shard_id)
+                for record in records:
+                    output.write(record_to_json(shard_id, record) + "\n")
+                if reporter is not None:
+                    reporter.add(len(records), sum(len(record.data) for record in records))
+                if shard_iterators.is_closed(shard_id) or \
+                        (not records and shard_iterators.millis_behind_latest(shard_id) == 0):
+                    break
+                if not records:
+                    time.sleep(stream.read_interval)
+
+    workers = [Thread(target=work, name="pynesis-dump-{}".format(i))
+               for i in range(concurrency or shards.qsize())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return failed_shards
+
+
+def tail(stream, output, reporter=None):  # type: (KinesisStream, IO[str], ThroughputReporter) -> None
+    """
+    Writes each record read from the stream into `output` until the stream is stopped,
+    checkpointing the records once written
+    """
+    for shard_id, records, checkpoint_sequence in stream.read_shard_batches():
+        for record in records:
+            output.write(record_to_json(shard_id, record) + "\n")
+        output.flush()
+        if reporter is not None:
+            reporter.add(len(records), sum(len(record.data) for record in records))
+        if checkpoint_sequence is not None:
+            stream.checkpointer.checkpoint(shard_id, checkpoint_sequence)
+
+
+def build_parser():  # type: () -> argparse.ArgumentParser
+    parser = argparse.ArgumentParser(prog="python -m pynesis", description="Kinesis streams command line tool")
+    parser.add_argument("--region", help="AWS region, taken from the AWS configuration by default")
+    subparsers = parser.add_subparsers(dest="command")
+
+    put_parser = subparsers.add_parser("put", help="Put the JSON lines of a file into a stream")
+    put_parser.add_argument("stream")
+    put_parser.add_argument("file", help="File to load, - for stdin")
+    put_parser.add_argument("--key-field", help="Field of each JSON line to use as partition key")
+    put_parser.add_argument("--batch-size", type=int, default=500)
+    put_parser.add_argument("--concurrency", type=int, default=4)
+
+    for name, help_text in (("tail", "Print the records of a stream as they arrive"),
+                            ("dump", "Write all the records of a stream into a file per shard")):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument("stream")
+        if name == "dump":
+            subparser.add_argument("directory")
+            subparser.add_argument("--concurrency", type=int, help="Shards read at a time, all of them by default")
+        subparser.add_argument("--from-timestamp", type=parse_timestamp,
+                               help="Start from records arrived after this UTC time (epoch or YYYY-MM-DDTHH:MM:SS)")
+        subparser.add_argument("--checkpointer",
+                               help="Dotted path of a Checkpointer class to start from the positions it stores")
+        subparser.add_argument("--checkpointer-options", type=json.loads, default={},
+                               help="JSON object with the checkpointer constructor keyword arguments")
+    return parser
+
+
+def build_stream(options, kinesis_client=None):  # type: (argparse.Namespace, Any) -> KinesisStream
+    stream_options = {}  # type: Dict[str, Any]
+    if options.command == "tail":
+        stream_options["iterator_type"] = "LATEST"
+    if getattr(options, "from_timestamp", None) is not None:
+        stream_options.update(iterator_type="AT_TIMESTAMP", iterator_timestamp=options.from_timestamp)
+    if getattr(options, "checkpointer", None) is not None:
+        module_name, class_name = options.checkpointer.rsplit(".", 1)
+        checkpointer_class = getattr(__import__(module_name, fromlist=[class_name]), class_name)
+        stream_options["checkpointer"] = checkpointer_class(**options.checkpointer_options)
+    return KinesisStream(options.stream, region_name=options.region, kinesis_client=kinesis_client,
+                         **stream_options)
+
+
+def main(argv=None, kinesis_client=None, output=None):  # type: (List[str], Any, IO[str]) -> int
+    options = build_parser().parse_args(argv)
+    output = output or sys.stdout
+    if options.command is None:
+        build_parser().print_help()
+        return 2
+
+    stream = build_stream(options, kinesis_client)
+    reporter = ThroughputReporter()
+    reporter.start()
+    try:
+        if options.command == "put":
+            lines = sys.stdin if options.file == "-" else open(options.file)  # type: IO[str]
+            with lines:
+                failed = put(stream, lines, key_field=options.key_field, batch_size=options.batch_size,
+                             concurrency=options.concurrency, reporter=reporter)
+            if failed:
+                logger.error("{} records could not be put".format(failed))
+                return 1
+        elif options.command == "dump":
+            failed_shards = dump(stream, options.directory, concurrency=options.concurrency, reporter=reporter)
+            if failed_shards:
+                logger.error("Shards {} could not be dumped".format(", ".join(sorted(failed_shards))))
+                return 1
+        else:
+            tail(stream, output, reporter=reporter)
+    except KeyboardInterrupt:
+        stream.stop()
+    finally:
+        reporter.stop()
+    return 0
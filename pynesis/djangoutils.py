@@ -1,11 +1,13 @@
-from threading import local
-from typing import Dict  # noqa
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Tuple  # noqa
 
 from pynesis.streams import Stream
 from pynesis.checkpointers import Checkpointer
-from pynesis.models import Checkpoint
 
-_cache = local()
+logger = logging.getLogger(__name__)
 
 try:
     import json
@@ -18,20 +20,37 @@ except AttributeError:
     JSONDecodeError = ValueError
 
 
-def get_stream(name):  # type: (str) -> Stream
+class StreamRegistry(object):
     """
-    This is a helper method which will return a Stream instance whose configuration
-    will be obtained from django settings module
-
-    See the project README for examples
+    Process wide registry of the streams configured in the PYNESIS_CONFIG django setting.
 
+    Each stream is built the first time it is requested and then shared by every thread
+    of the process. Streams sharing region and credentials also share a single pooled boto3 client
+    (see pynesis.streams.get_kinesis_client), use the "max_pool_connections" backend option to size its pool.
     """
-    from django.conf import settings
-    from django.utils.module_loading import import_string
+    def __init__(self):  # type: () -> None
+        self._streams = {}  # type: Dict[str, Stream]
+        self._lock = Lock()
+
+    def get(self, name):  # type: (str) -> Stream
+        try:
+            return self._streams[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name not in self._streams:
+                self._streams[name] = self._build(name)
+        return self._streams[name]
+
+    def clear(self):  # type: () -> None
+        with self._lock:
+            self._streams = {}
+
+    def _build(self, name):  # type: (str) -> Stream
+        from django.conf import settings
+        from django.utils.module_loading import import_string
 
-    try:
-        backend_instance = _cache.instance
-    except AttributeError:
         pynesis_config = getattr(settings, "PYNESIS_CONFIG", {}).get(name, {})
         backend_options = pynesis_config.get("BACKEND_OPTIONS", {})
         checkpointer_options = pynesis_config.get("CHECKPOINTER_OPTIONS", {})
@@ -42,8 +61,109 @@ def get_stream(name):  # type: (str) -> Stream
         backend_instance = backend_class(checkpointer=checkpointer_instance, **backend_options)
         assert isinstance(backend_instance, Stream)
         assert isinstance(checkpointer_instance, Checkpointer)
-        _cache.instance = backend_instance
-    return backend_instance
+        return backend_instance
+
+
+registry = StreamRegistry()
+
+
+def get_stream(name):  # type: (str) -> Stream
+    """
+    This is a helper method which will return a Stream instance whose configuration
+    will be obtained from django settings module
+
+    See the project README for examples
+
+    """
+    return registry.get(name)
+
+
+def put_outbox(name, key, data, on_commit=False):  # type: (str, str, bytes, bool) -> None
+    """
+    Stores a record for the stream configured as `name` into the outbox table, to be published
+    later by an OutboxDrainer.
+
+    The record is written within the caller's database transaction, so it is only published if that
+    transaction commits. With on_commit=True the write is deferred until the current transaction commits.
+    """
+    from django.db import transaction
+    from pynesis.models import OutboxRecord
+
+    def write():  # type: () -> None
+        OutboxRecord.objects.create(stream=name, key=key, data=data)
+
+    if on_commit:
+        transaction.on_commit(write)
+    else:
+        write()
+
+
+class OutboxDrainer(object):
+    """
+    Publishes the records stored with put_outbox() using batched PutRecords calls, and removes them
+    from the outbox once Kinesis has accepted them. Records rejected by Kinesis stay for the next run.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several drainers can run in parallel
+    without publishing the same record twice. Note that with more than one drainer the records of a given
+    key may be published out of order. Before Django 1.11, which lacks SKIP LOCKED, parallel drainers wait
+    for each other instead.
+    """
+    def __init__(self, batch_size=500, interval=1):  # type: (int, int) -> None
+        self._batch_size = batch_size
+        self._interval = interval
+        self._stop = False
+
+    def stop(self):  # type: () -> None
+        """
+        Makes drain() return after the batch being published
+        """
+        self._stop = True
+
+    def drain(self):  # type: () -> None
+        """
+        Publishes outbox records until stop() is called, waiting `interval` seconds when the outbox is empty
+        """
+        while not self._stop:
+            if not self.drain_once():
+                time.sleep(self._interval)
+
+    def drain_once(self):  # type: () -> int
+        """
+        Publishes a batch of outbox records for each stream having records among the oldest `batch_size` ones,
+        returning the number of records published. Each stream is published in its own transaction, so the
+        records published for a stream are removed even if publishing another stream fails.
+        """
+        from pynesis.models import OutboxRecord
+
+        oldest_streams = OutboxRecord.objects.order_by("id").values_list("stream", flat=True)[:self._batch_size]
+        published = 0
+        for name in OrderedDict.fromkeys(oldest_streams):
+            published += self._drain_stream(name)
+        return published
+
+    def _drain_stream(self, name):  # type: (str) -> int
+        import django
+        from django.db import transaction
+        from pynesis.models import OutboxRecord
+
+        with transaction.atomic():
+            queryset = OutboxRecord.objects.filter(stream=name)
+            if django.VERSION >= (1, 11):
+                queryset = queryset.select_for_update(skip_locked=True)
+            else:
+                queryset = queryset.select_for_update()
+            rows = list(queryset.order_by("id")[:self._batch_size])
+            if not rows:
+                return 0
+
+            records = [(row.key, bytes(row.data)) for row in rows]
+            failed = get_stream(name).put_records(records)
+            failed_records = set(id(record) for record in failed)
+            published = [row.pk for row, record in zip(rows, records) if id(record) not in failed_records]
+            if failed:
+                logger.warning("{} outbox records for stream {} were not accepted".format(len(failed), name))
+            OutboxRecord.objects.filter(pk__in=published).delete()
+        return len(published)
 
 
 class DjangoCheckpointer(Checkpointer):
@@ -58,12 +178,16 @@ class DjangoCheckpointer(Checkpointer):
         self._checkpoints = {}
 
     def get_all_checkpoints(self):  # type: ()->Dict[str,str]
+        from pynesis.models import Checkpoint
+
         if not self._checkpoints:
             checkpoint, created = Checkpoint.objects.get_or_create(key=self._key, defaults={"checkpoints": "{}"})
             self._checkpoints = json.loads(checkpoint.checkpoints)
         return self._checkpoints
 
     def checkpoint(self, shard_id, sequence):  # type: (str,str) -> None
+        from pynesis.models import Checkpoint
+
         self._checkpoints[shard_id] = sequence
         checkpoint_data = json.dumps(self._checkpoints)
         Checkpoint.objects.update_or_create(key=self._key, defaults={"checkpoints": checkpoint_data})
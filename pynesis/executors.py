@@ -0,0 +1,153 @@
+import logging
+from collections import deque
+from threading import Thread
+from typing import Any, Callable, Deque, Dict, List, Optional  # noqa
+
+from six.moves.queue import Empty, Queue
+
+from pynesis.streams import KinesisRecord, KinesisStream  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+class _Task(object):
+    __slots__ = ("shard_id", "record", "sequence_number", "done")
+
+    def __init__(self, shard_id, record):  # type: (str, KinesisRecord) -> None
+        self.shard_id = shard_id
+        self.record = record
+        self.sequence_number = record.sequence_number  # Where to checkpoint the shard once done
+        self.done = False
+
+
+class PartitionKeyExecutor(object):
+    """
+    Runs a handler for the records of a KinesisStream in a pool of threads.
+
+    Kinesis only guarantees the order of the records sharing a partition key, so records with different
+    keys are handled concurrently while the records of each key are still handled one after the other,
+    in the order they were read. The position of each shard is checkpointed up to the last record
+    before the oldest record of that shard which is still being handled (or waiting to be).
+
+    At most `max_pending` records are read ahead of the handlers. If the handler raises an exception,
+    the stream is stopped, the records already being handled are completed, and run() raises it.
+    """
+    def __init__(self,
+                 stream,  # type: KinesisStream
+                 handler,  # type: Callable[[KinesisRecord], Any]
+                 max_workers=32,  # type: int
+                 max_pending=1000,  # type: int
+                 ):  # type: (...) -> None
+        self._stream = stream
+        self._handler = handler
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._tasks = Queue()  # type: Queue
+        self._completions = Queue()  # type: Queue
+        self._shards = {}  # type: Dict[str, Deque[_Task]]
+        self._keys = {}  # type: Dict[str, Deque[_Task]]
+        self._pending = 0
+        self._error = None  # type: Optional[Exception]
+
+    def stop(self):  # type: () -> None
+        """
+        Stops reading the stream, making run() return once the records already read are handled
+        """
+        self._stream.stop()
+
+    def run(self):  # type: () -> None
+        """
+        Reads and handles the stream records until stop() is called
+        """
+        workers = [Thread(target=self._work, name="pynesis-executor-{}".format(i)) for i in range(self._max_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        batches = self._stream.read_shard_batches()
+        try:
+            for shard_id, records, checkpoint_sequence in batches:
+                for record in records:
+                    self._submit(_Task(shard_id, record))
+                if checkpoint_sequence is not None and (not records or
+                                                        records[-1].sequence_number != checkpoint_sequence):
+                    self._skip(shard_id, checkpoint_sequence)
+                self._complete(block=False)
+                while self._pending >= self._max_pending:
+                    self._complete(block=True)
+                if self._error is not None:
+                    break
+        finally:
+            batches.close()
+            while self._pending:
+                self._complete(block=True)
+            for _ in workers:
+                self._tasks.put(None)
+            self._stream.checkpointer.flush()
+
+        if self._error is not None:
+            raise self._error
+
+    def _submit(self, task):  # type: (_Task) -> None
+        self._shards.setdefault(task.shard_id, deque()).append(task)
+        key_tasks = self._keys.setdefault(task.record.partition_key, deque())
+        key_tasks.append(task)
+        self._pending += 1
+        if len(key_tasks) == 1:
+            self._tasks.put(task)
+
+    def _skip(self, shard_id, sequence_number):  # type: (str, str) -> None
+        """
+        Checkpoints the records discarded at the end of a batch once the records read before them are handled
+        """
+        shard_tasks = self._shards.get(shard_id)
+        if shard_tasks:
+            shard_tasks[-1].sequence_number = sequence_number
+        else:
+            self._stream.checkpointer.checkpoint(shard_id, sequence_number)
+
+    def _complete(self, block):  # type: (bool) -> None
+        while self._pending:
+            try:
+                task, error = self._completions.get(block=block)
+            except Empty:
+                return
+            block = False
+
+            key_tasks = self._keys[task.record.partition_key]
+            key_tasks.popleft()
+            self._pending -= 1
+            if error is not None:
+                logger.error("Error handling record {} from shard {}".format(task.record.sequence_number,
+                                                                             task.shard_id))
+                if self._error is None:
+                    self._error = error
+                    self._stream.stop()
+                self._pending -= len(key_tasks)
+                key_tasks.clear()
+            else:
+                task.done = True
+                self._advance_checkpoint(task.shard_id)
+                if key_tasks:
+                    self._tasks.put(key_tasks[0])
+            if not key_tasks:
+                del self._keys[task.record.partition_key]
+
+    def _advance_checkpoint(self, shard_id):  # type: (str) -> None
+        shard_tasks = self._shards[shard_id]
+        last_done = None  # type: Optional[_Task]
+        while shard_tasks and shard_tasks[0].done:
+            last_done = shard_tasks.popleft()
+        if last_done is not None:
+            self._stream.checkpointer.checkpoint(shard_id, last_done.sequence_number)
+
+    def _work(self):  # type: () -> None
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            try:
+                self._handler(task.record)
+                self._completions.put((task, None))
+            except Exception as error:
+                self._completions.put((task, error))
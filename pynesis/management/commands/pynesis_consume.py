@@ -0,0 +1,132 @@
+import logging
+import os
+import signal
+from threading import Thread
+from typing import Any, Callable, Dict, List  # noqa
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.utils.module_loading import import_string
+
+from pynesis.djangoutils import get_stream
+from pynesis.streams import KinesisRecord, Stream  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """
+    Consumes several streams configured in PYNESIS_CONFIG from a single process, with a thread per stream.
+    Each record is passed to the callable configured as the "HANDLER" of its stream, and database
+    connections are recycled after each batch. SIGTERM/SIGINT stop the streams after the batch in progress.
+    """
+
+    JOIN_INTERVAL = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument("streams", nargs="*",
+                            help="Names of the streams to consume, all those with a HANDLER by default")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of processes to fork, each of them consuming a share of the streams")
+
+    def handle(self, *args, **options):
+        pynesis_config = getattr(settings, "PYNESIS_CONFIG", {})  # type: Dict[str, Dict[str, Any]]
+        names = options["streams"] or sorted(name for name, config in pynesis_config.items() if "HANDLER" in config)
+        if not names:
+            raise CommandError("There are no streams to consume")
+
+        handlers = {}  # type: Dict[str, Callable[[KinesisRecord], Any]]
+        for name in names:
+            handler_path = pynesis_config.get(name, {}).get("HANDLER")
+            if handler_path is None:
+                raise CommandError("Stream {} has no HANDLER configured".format(name))
+            handlers[name] = import_string(handler_path)
+
+        workers = min(options["workers"], len(names))
+        if workers <= 1:
+            self._consume(handlers)
+        else:
+            self._fork(handlers, workers)
+
+    def _fork(self, handlers, workers):  # type: (Dict[str, Callable[[KinesisRecord], Any]], int) -> None
+        names = sorted(handlers)
+        connections.close_all()
+        children = []  # type: List[int]
+        for worker in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self._consume({name: handlers[name] for name in names[worker::workers]})
+                    status = 0
+                except Exception:
+                    # The child never returns to the caller, which would otherwise log the error
+                    logger.exception("Worker {} failed".format(worker))
+                finally:
+                    os._exit(status)
+            children.append(pid)
+
+        def terminate(signum, frame):
+            for child in children:
+                os.kill(child, signal.SIGTERM)
+
+        previous_handlers = self._install_signal_handlers(terminate)
+        failed_workers = 0
+        try:
+            for child in children:
+                pid, status = os.waitpid(child, 0)
+                if status != 0:
+                    failed_workers += 1
+        finally:
+            self._install_signal_handlers(*previous_handlers)
+        if failed_workers:
+            raise CommandError("{} workers failed".format(failed_workers))
+
+    def _consume(self, handlers):  # type: (Dict[str, Callable[[KinesisRecord], Any]]) -> None
+        streams = {name: get_stream(name) for name in handlers}
+        failed_streams = []  # type: List[str]
+
+        def stop(signum=None, frame=None):
+            for stream in streams.values():
+                stream.stop()
+
+        threads = []  # type: List[Thread]
+        for name, stream in streams.items():
+            thread = Thread(target=self._consume_stream, args=(name, stream, handlers[name], stop, failed_streams),
+                            name="pynesis-consume-{}".format(name))
+            thread.start()
+            threads.append(thread)
+
+        previous_handlers = self._install_signal_handlers(stop)
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(self.JOIN_INTERVAL)
+        finally:
+            self._install_signal_handlers(*previous_handlers)
+        if failed_streams:
+            raise CommandError("Error consuming streams {}".format(", ".join(failed_streams)))
+
+    def _consume_stream(self, name, stream, handler, stop, failed_streams):
+        # type: (str, Stream, Callable[[KinesisRecord], Any], Callable[[], None], List[str]) -> None
+        logger.info("Consuming stream {}".format(name))
+        try:
+            for records in stream.read_batches():
+                for record in records:
+                    handler(record)
+                close_old_connections()
+        except Exception:
+            logger.exception("Error consuming stream {}, stopping all streams".format(name))
+            failed_streams.append(name)
+            stop()
+        finally:
+            close_old_connections()
+        logger.info("Stopped consuming stream {}".format(name))
+
+    @staticmethod
+    def _install_signal_handlers(sigterm_handler, sigint_handler=None):  # type: (Any, Any) -> List[Any]
+        previous = [signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)]
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        signal.signal(signal.SIGINT, sigint_handler if sigint_handler is not None else sigterm_handler)
+        return previous
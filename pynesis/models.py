@@ -7,3 +7,13 @@ class Checkpoint(models.Model):
 
     class Meta:
         app_label = "pynesis"
+
+
+class OutboxRecord(models.Model):
+    stream = models.CharField(max_length=255)
+    key = models.CharField(max_length=256)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = "pynesis"
@@ -0,0 +1,136 @@
+import logging
+import time
+from typing import Dict, Generator, List, Optional, Tuple  # noqa
+
+from pynesis.streams import KinesisRecord, KinesisStream, ShardIterators  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate of calls shared by several readers
+    """
+    def __init__(self, calls_per_second):  # type: (float) -> None
+        self._calls_per_second = calls_per_second
+        self._tokens = calls_per_second
+        self._last_refill = time.time()
+
+    def acquire(self):  # type: () -> None
+        """
+        Blocks until a call is allowed
+        """
+        while True:
+            now = time.time()
+            self._tokens = min(self._calls_per_second,
+                               self._tokens + (now - self._last_refill) * self._calls_per_second)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self._calls_per_second)
+
+
+class _ShardState(object):
+    def __init__(self, shard_id):  # type: (str) -> None
+        self.shard_id = shard_id
+        self.next_poll = 0.0
+
+
+class _StreamState(object):
+    def __init__(self, stream, weight):  # type: (KinesisStream, float) -> None
+        self.stream = stream
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.iterators = ShardIterators(stream)
+        self.shards = {}  # type: Dict[str, _ShardState]
+
+    def update_shards(self):  # type: () -> None
+        self.iterators.update()
+        shard_ids = self.iterators.shard_ids()
+        for shard_id in shard_ids:
+            if shard_id not in self.shards:
+                self.shards[shard_id] = _ShardState(shard_id)
+        for shard_id in list(self.shards):
+            if shard_id not in shard_ids:
+                del self.shards[shard_id]
+
+    def next_shard(self):  # type: () -> _ShardState
+        return min(self.shards.values(), key=lambda shard: shard.next_poll)
+
+
+class MultiStreamReader(object):
+    """
+    Reads from several KinesisStream instances from a single thread.
+
+    Instead of a read() loop per stream sleeping `read_interval` between rounds, a single scheduler
+    polls the shard of all the streams which has waited the longest, choosing between streams in
+    proportion to their weights (weighted fair queuing over the number of records read). Each shard is
+    polled at most 5 times per second as allowed by Kinesis, shards returning no records wait for the
+    `read_interval` of their stream, and `max_calls_per_second` limits the GetRecords calls of all the
+    streams together.
+
+    Records are checkpointed with the Checkpointer of their stream once the next one is requested, and
+    streams sharing region and credentials share a single boto3 client (see pynesis.streams.get_kinesis_client).
+    """
+    SHARD_MIN_INTERVAL = 0.2
+
+    def __init__(self,
+                 streams,  # type: List[KinesisStream]
+                 weights=None,  # type: Dict[str, float]
+                 max_calls_per_second=None,  # type: float
+                 ):  # type: (...) -> None
+        weights = weights or {}
+        self._streams = [_StreamState(stream, weights.get(stream.stream_name, 1)) for stream in streams]
+        self._rate_limiter = None  # type: Optional[RateLimiter]
+        if max_calls_per_second is not None:
+            self._rate_limiter = RateLimiter(max_calls_per_second)
+        self._stop = False
+
+    def stop(self):  # type: () -> None
+        """
+        Stops the yielding of records from the read() method and makes it return
+        """
+        self._stop = True
+
+    def read(self):  # type: () -> Generator[Tuple[str, KinesisRecord], None, None]
+        """
+        Yields (stream name, record) tuples from all the streams, one at a time
+        """
+        try:
+            while not self._stop:
+                for state in self._streams:
+                    state.update_shards()
+
+                now = time.time()
+                ready = [state for state in self._streams if state.shards and state.next_shard().next_poll <= now]
+                if not ready:
+                    next_polls = [state.next_shard().next_poll for state in self._streams if state.shards]
+                    time.sleep(max(min(next_polls) - now, 0) if next_polls else self.SHARD_MIN_INTERVAL)
+                    continue
+
+                state = min(ready, key=lambda ready_state: ready_state.virtual_time)
+                shard = state.next_shard()
+                if self._rate_limiter is not None:
+                    self._rate_limiter.acquire()
+                position = state.iterators.position(shard.shard_id)
+                records = state.iterators.get_records(shard.shard_id)
+                shard.next_poll = time.time() + (self.SHARD_MIN_INTERVAL if records else state.stream.read_interval)
+
+                # Streams becoming ready after being idle don't get a burst of polls to catch up
+                virtual_time = state.virtual_time
+                state.virtual_time += max(len(records), 1) / float(state.weight)
+                for other in self._streams:
+                    other.virtual_time = max(other.virtual_time, virtual_time)
+
+                for record in records:
+                    yield state.stream.stream_name, record
+                    state.stream.checkpointer.checkpoint(shard.shard_id, record.sequence_number)
+                # Records discarded for being older than the stream max_age are checkpointed too
+                last_position = state.iterators.position(shard.shard_id)
+                if last_position is not None and last_position != position and \
+                        (not records or records[-1].sequence_number != last_position):
+                    state.stream.checkpointer.checkpoint(shard.shard_id, last_position)
+        finally:
+            for state in self._streams:
+                state.stream.checkpointer.flush()
@@ -0,0 +1,307 @@
+"""
+Local disk spool of consumed records, to keep reading a stream (and checkpointing it) while the
+records can not be delivered, and deliver them later from the disk.
+
+The spool directory holds numbered segments, each one made of two files:
+
+ - `<number>.log`: The records, one after the other, each with a header holding the CRC32 of the rest
+   of the record, the sizes of its fields and its arrival timestamp, followed by the shard id, sequence
+   number, partition key and data.
+ - `<number>.idx`: The offset of each record in the .log file, as little endian 64 bits integers.
+
+Records are appended to the last segment until it grows past `segment_max_bytes`, then a new one starts.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Generator, List, Optional, Tuple  # noqa
+from zlib import crc32
+
+from pynesis.streams import KinesisRecord, KinesisStream, epoch_millis  # noqa
+
+logger = logging.getLogger(__name__)
+
+_CHECKSUM = struct.Struct(">I")
+_OFFSET = struct.Struct("<q")
+# data size, arrival timestamp (epoch milliseconds), shard id size, sequence number size, partition key size
+_FIELDS = struct.Struct(">IqHHH")
+
+
+class SpoolCorruptedException(Exception):
+    pass
+
+
+def _segment_path(directory, number, extension):  # type: (str, int, str) -> str
+    return os.path.join(directory, "{:010d}.{}".format(number, extension))
+
+
+def _segment_numbers(directory):  # type: (str) -> List[int]
+    return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log") and name[:-4].isdigit())
+
+
+def _read_index(directory, number):  # type: (str, int) -> List[int]
+    path = _segment_path(directory, number, "idx")
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as index_file:
+        data = index_file.read()
+    count = len(data) // _OFFSET.size
+    return list(struct.unpack("<{}q".format(count), data[:count * _OFFSET.size]))
+
+
+def _index_bytes(offsets):  # type: (List[int]) -> bytes
+    return struct.pack("<{}q".format(len(offsets)), *offsets)
+
+
+def _encode(shard_id, record):  # type: (str, KinesisRecord) -> bytes
+    shard_id_bytes = shard_id.encode("utf-8")
+    sequence_bytes = record.sequence_number.encode("utf-8")
+    key_bytes = (record.partition_key or "").encode("utf-8")
+    body = _FIELDS.pack(len(record.data), epoch_millis(record.approximate_arrival_timestamp),
+                        len(shard_id_bytes), len(sequence_bytes), len(key_bytes)) + \
+        shard_id_bytes + sequence_bytes + key_bytes + record.data
+    return _CHECKSUM.pack(crc32(body) & 0xffffffff) + body
+
+
+def _decode(buffer, offset):  # type: (Any, int) -> Tuple[str, KinesisRecord, int]
+    """
+    Returns the (shard id, record, end offset) of the record at `offset`, raising SpoolCorruptedException
+    if it is truncated or does not match its CRC
+    """
+    position = offset + _CHECKSUM.size + _FIELDS.size
+    if position > len(buffer):
+        raise SpoolCorruptedException("Truncated record header at offset {}".format(offset))
+    checksum, = _CHECKSUM.unpack_from(buffer, offset)
+    data_size, arrival, shard_id_size, sequence_size, key_size = _FIELDS.unpack_from(buffer, offset + _CHECKSUM.size)
+    end = position + shard_id_size + sequence_size + key_size + data_size
+    if end > len(buffer) or crc32(buffer[offset + _CHECKSUM.size:end]) & 0xffffffff != checksum:
+        raise SpoolCorruptedException("Corrupted record at offset {}".format(offset))
+
+    shard_id = bytes(buffer[position:position + shard_id_size]).decode("utf-8")
+    position += shard_id_size
+    sequence_number = bytes(buffer[position:position + sequence_size]).decode("utf-8")
+    position += sequence_size
+    partition_key = bytes(buffer[position:position + key_size]).decode("utf-8")
+    position += key_size
+    record = KinesisRecord.build(
+        sequence_number=sequence_number,
+        approximate_arrival_timestamp=datetime(1970, 1, 1) + timedelta(milliseconds=arrival),
+        data=bytes(buffer[position:end]),
+        partition_key=partition_key,
+    )
+    return shard_id, record, end
+
+
+def _fsync_directory(directory):  # type: (str) -> None
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class Spool(object):
+    """
+    Appends records to segment files in `directory` (see the module documentation).
+
+    Once a new segment is started, the oldest ones are deleted while the spool takes more than `max_bytes`,
+    and those last written more than `max_age` seconds ago are deleted too.
+    """
+    def __init__(self,
+                 directory,  # type: str
+                 segment_max_bytes=64 * 1024 * 1024,  # type: int
+                 max_bytes=None,  # type: int
+                 max_age=None,  # type: float
+                 ):  # type: (...) -> None
+        self._directory = directory
+        self._segment_max_bytes = segment_max_bytes
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        numbers = _segment_numbers(directory)
+        self._number = numbers[-1] if numbers else 0
+        self._size = self._recover(self._number) if numbers else 0
+        self._log = open(_segment_path(directory, self._number, "log"), "ab")
+        self._index = open(_segment_path(directory, self._number, "idx"), "ab")
+        if not numbers:
+            _fsync_directory(directory)
+
+    @property
+    def directory(self):  # type: () -> str
+        return self._directory
+
+    def append(self, shard_id, records):  # type: (str, List[KinesisRecord]) -> None
+        """
+        Appends the records read from a shard, returning once they are written to disk
+        """
+        if self._size >= self._segment_max_bytes:
+            self._rotate()
+
+        offsets = []  # type: List[int]
+        chunks = []
+        for record in records:
+            chunk = _encode(shard_id, record)
+            offsets.append(self._size)
+            self._size += len(chunk)
+            chunks.append(chunk)
+        self._log.write(b"".join(chunks))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._index.write(_index_bytes(offsets))
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+    def consume(self, stream):  # type: (KinesisStream) -> None
+        """
+        Appends the records read from the stream until it is stopped, checkpointing each batch once it is on disk
+        """
+        for shard_id, records, checkpoint_sequence in stream.read_shard_batches():
+            if records:
+                self.append(shard_id, records)
+            if checkpoint_sequence is not None:
+                stream.checkpointer.checkpoint(shard_id, checkpoint_sequence)
+
+    def close(self):  # type: () -> None
+        self._log.close()
+        self._index.close()
+
+    def _rotate(self):  # type: () -> None
+        self.close()
+        self._number += 1
+        self._size = 0
+        self._log = open(_segment_path(self._directory, self._number, "log"), "ab")
+        self._index = open(_segment_path(self._directory, self._number, "idx"), "ab")
+        _fsync_directory(self._directory)
+        self._apply_retention()
+
+    def _apply_retention(self):  # type: () -> None
+        now = time.time()
+        segments = [(number, os.path.getsize(_segment_path(self._directory, number, "log")),
+                     os.path.getmtime(_segment_path(self._directory, number, "log")))
+                    for number in _segment_numbers(self._directory) if number != self._number]
+        total_size = sum(size for number, size, modified in segments) + self._size
+        for number, size, modified in segments:
+            too_big = self._max_bytes is not None and total_size > self._max_bytes
+            too_old = self._max_age is not None and now - modified > self._max_age
+            if not too_big and not too_old:
+                continue
+            logger.info("Deleting spool segment {}".format(number))
+            for extension in ("log", "idx"):
+                os.remove(_segment_path(self._directory, number, extension))
+            total_size -= size
+
+    def _recover(self, number):  # type: (int) -> int
+        """
+        Truncates the segment after its last complete and valid record, returning its size
+        """
+        log_path = _segment_path(self._directory, number, "log")
+        index = _read_index(self._directory, number)
+        with open(log_path, "rb") as log:
+            data = log.read()
+
+        size = 0
+        valid = 0
+        for offset in index:
+            if offset != size:
+                break
+            try:
+                size = _decode(data, offset)[2]
+            except SpoolCorruptedException:
+                break
+            valid += 1
+
+        if valid < len(index) or size < len(data):
+            logger.warning("Truncating spool segment {} after {} records".format(number, valid))
+            with open(log_path, "r+b") as log:
+                log.truncate(size)
+            with open(_segment_path(self._directory, number, "idx"), "r+b") as index_file:
+                index_file.truncate(valid * _OFFSET.size)
+        return size
+
+
+class SpoolReplayer(object):
+    """
+    Reads back the records of a spool directory, in the order they were appended, using memory mapped files.
+
+    The position of the last record handled by replay() is stored in `position_path` (`replay.position`
+    in the spool directory by default), so that each replay continues where the previous one stopped.
+    """
+    def __init__(self, directory, position_path=None):  # type: (str, str) -> None
+        self._directory = directory
+        self._position_path = position_path or os.path.join(directory, "replay.position")
+        self._stop = False
+
+    @property
+    def position(self):  # type: () -> Tuple[int, int]
+        """
+        The (segment number, record index) of the next record to replay
+        """
+        if not os.path.exists(self._position_path):
+            return 0, 0
+        with open(self._position_path) as position_file:
+            position = json.load(position_file)
+        return position["segment"], position["index"]
+
+    def stop(self):  # type: () -> None
+        self._stop = True
+
+    def read(self, position=None):
+        # type: (Tuple[int, int]) -> Generator[Tuple[Tuple[int, int], str, KinesisRecord], None, None]
+        """
+        Yields the ((segment number, record index), shard id, record) of each record from `position`
+        (the stored one by default) up to the last one appended
+        """
+        segment, start = position if position is not None else self.position
+        for number in _segment_numbers(self._directory):
+            if number < segment:
+                continue
+            index = _read_index(self._directory, number)
+            first = start if number == segment else 0
+            if first >= len(index):
+                continue
+            with open(_segment_path(self._directory, number, "log"), "rb") as log:
+                buffer = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for i in range(first, len(index)):
+                        if self._stop:
+                            return
+                        shard_id, record, end = _decode(buffer, index[i])
+                        yield (number, i), shard_id, record
+                finally:
+                    buffer.close()
+
+    def replay(self, handler):  # type: (Callable[[str, KinesisRecord], Any]) -> int
+        """
+        Calls `handler(shard id, record)` for each record not replayed yet, storing the position as it goes.
+        Returns the number of records replayed.
+        """
+        self._stop = False
+        count = 0
+        position = None  # type: Optional[Tuple[int, int]]
+        try:
+            for (number, i), shard_id, record in self.read():
+                handler(shard_id, record)
+                position = (number, i + 1)
+                count += 1
+                if count % 1000 == 0:
+                    self._store_position(position)
+        finally:
+            if position is not None:
+                self._store_position(position)
+        return count
+
+    def _store_position(self, position):  # type: (Tuple[int, int]) -> None
+        temporary_path = self._position_path + ".tmp"
+        with open(temporary_path, "w") as position_file:
+            json.dump({"segment": position[0], "index": position[1]}, position_file)
+            position_file.flush()
+            os.fsync(position_file.fileno())
+        os.rename(temporary_path, self._position_path)
@@ -1,27 +1,140 @@
 import abc
+import calendar
 import logging
+import re
+import struct
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, tzinfo
+from collections import deque
 from itertools import cycle
-from threading import local
+from zlib import crc32
+from threading import Event, Lock, Thread, local
 from six import with_metaclass
-from typing import Dict, Generator, List, Optional, Tuple, Iterable, Any  # noqa
+from six.moves.queue import Empty, Full, Queue
+from typing import Callable, Deque, Dict, Generator, List, Optional, Pattern, Set, Tuple, Iterable, Any, Union  # noqa
 
-import boto3
-from botocore.exceptions import ClientError
 from six import raise_from
 
 from pynesis.checkpointers import Checkpointer, InMemoryCheckpointer  # noqa
+from pynesis.tracing import Tracer
 
 _cache = local()
 
+_kinesis_clients = {}  # type: Dict[Tuple, Any]
+_kinesis_clients_lock = Lock()
+
 logger = logging.getLogger(__name__)
 
 
+def get_kinesis_client(region_name,  # type: str
+                       aws_access_key_id=None,  # type: str
+                       aws_secret_access_key=None,  # type: str
+                       max_pool_connections=None,  # type: int
+                       connect_timeout=None,  # type: float
+                       read_timeout=None,  # type: float
+                       ):  # type: (...) -> Any
+    """
+    Returns a boto3 kinesis client shared by every stream of the process using the same region,
+    credentials, connection pool size and timeouts.
+
+    boto3 clients are thread safe, so sharing them avoids building a client (and a cold connection pool)
+    for every stream and thread. Pooled connections use TCP keep-alive so idle ones are not dropped.
+    When reading from several shards concurrently, max_pool_connections should be at least the number of shards.
+    """
+    key = (region_name, aws_access_key_id, aws_secret_access_key, max_pool_connections, connect_timeout, read_timeout)
+    with _kinesis_clients_lock:
+        client = _kinesis_clients.get(key)
+        if client is None:
+            client = _build_kinesis_client(region_name, aws_access_key_id, aws_secret_access_key,
+                                           max_pool_connections, connect_timeout, read_timeout)
+            _kinesis_clients[key] = client
+    return client
+
+
+def _build_kinesis_client(region_name,  # type: str
+                          aws_access_key_id=None,  # type: str
+                          aws_secret_access_key=None,  # type: str
+                          max_pool_connections=None,  # type: int
+                          connect_timeout=None,  # type: float
+                          read_timeout=None,  # type: float
+                          ):  # type: (...) -> Any
+    import boto3
+    from botocore.config import Config
+
+    config_options = {}  # type: Dict[str, Any]
+    if "tcp_keepalive" in getattr(Config, "OPTION_DEFAULTS", {}):  # Not supported by older botocore versions
+        config_options["tcp_keepalive"] = True
+    if max_pool_connections is not None:
+        config_options["max_pool_connections"] = max_pool_connections
+    if connect_timeout is not None:
+        config_options["connect_timeout"] = connect_timeout
+    if read_timeout is not None:
+        config_options["read_timeout"] = read_timeout
+    return boto3.client("kinesis", region_name=region_name, aws_access_key_id=aws_access_key_id,
+                        aws_secret_access_key=aws_secret_access_key, config=Config(**config_options))
+
+
+def _build_records(raw_records, record_filter=None):
+    # type: (List[Dict], Callable[[Dict], bool]) -> Any
+    if record_filter is not None:
+        return [KinesisRecord(raw_record) for raw_record in raw_records if record_filter(raw_record)]
+    return [KinesisRecord(raw_record) for raw_record in raw_records]
+
+
+def _batch_position(previous_position, position):  # type: (Optional[str], Optional[str]) -> Optional[str]
+    """
+    The position to checkpoint once a batch is handled: the sequence number of the last record read
+    by the batch (whether the record was yielded or filtered out), or None if the batch read nothing
+    """
+    if position is None or position == previous_position:
+        return None
+    return position
+
+
+_ShardBatches = Generator[Tuple[str, List["KinesisRecord"], Optional[str]], None, None]
+
+
+class _UTC(tzinfo):
+    def utcoffset(self, dt):  # type: (Optional[datetime]) -> timedelta
+        return timedelta(0)
+
+    def dst(self, dt):  # type: (Optional[datetime]) -> timedelta
+        return timedelta(0)
+
+    def tzname(self, dt):  # type: (Optional[datetime]) -> str
+        return "UTC"
+
+
+_utc = _UTC()
+
+
+class _MaxAgeFilter(object):
+    """
+    Discards the records that arrived before `cutoff` (a naive UTC datetime), counting them in `stale`,
+    then applies `record_filter` to the others
+    """
+    def __init__(self, cutoff, record_filter=None):  # type: (datetime, Callable[[Dict], bool]) -> None
+        self._cutoff = cutoff
+        self._aware_cutoff = cutoff.replace(tzinfo=_utc)
+        self._record_filter = record_filter
+        self.stale = 0
+
+    def __call__(self, raw_record):  # type: (Dict) -> bool
+        timestamp = raw_record.get("ApproximateArrivalTimestamp")
+        if timestamp is not None and timestamp < (self._cutoff if timestamp.tzinfo is None else self._aware_cutoff):
+            self.stale += 1
+            return False
+        return self._record_filter is None or self._record_filter(raw_record)
+
+
 class StreamReadingException(Exception):
     pass
 
 
+class ExpiredIteratorException(StreamReadingException):
+    pass
+
+
 class KinesisGetRecordsResponse(object):
     def __init__(self, raw_response):  # type: (Dict) -> None
         self._raw_response = raw_response
@@ -30,10 +143,23 @@ class KinesisGetRecordsResponse(object):
     def records(self):  # type: ()->List[KinesisRecord]
         return [KinesisRecord(record) for record in self._raw_response.get("Records", [])]
 
+    @property
+    def raw_records(self):  # type: ()->List[Dict]
+        return self._raw_response.get("Records", [])
+
+    @property
+    def last_sequence_number(self):  # type: ()->Optional[str]
+        raw_records = self.raw_records
+        return raw_records[-1].get("SequenceNumber") if raw_records else None
+
     @property
     def next_shard_iterator(self):  # type: ()->str
         return self._raw_response.get("NextShardIterator", "")
 
+    @property
+    def millis_behind_latest(self):  # type: ()->Optional[int]
+        return self._raw_response.get("MillisBehindLatest")
+
 
 class KinesisDescribeStreamResponse(object):
     def __init__(self, raw_response):  # type: (Dict)->None
@@ -44,6 +170,23 @@ class KinesisDescribeStreamResponse(object):
         return [KinesisShard(shard) for shard in self._raw_response.get("StreamDescription", {}).get("Shards", [])]
 
 
+class KinesisSubscribeToShardEvent(object):
+    def __init__(self, raw_event):  # type: (Dict) -> None
+        self._raw_event = raw_event.get("SubscribeToShardEvent", {})
+
+    @property
+    def raw_records(self):  # type: ()->List[Dict]
+        return self._raw_event.get("Records", [])
+
+    @property
+    def continuation_sequence_number(self):  # type: ()->Optional[str]
+        return self._raw_event.get("ContinuationSequenceNumber")
+
+    @property
+    def shard_ended(self):  # type: ()->bool
+        return bool(self._raw_event.get("ChildShards"))
+
+
 class KinesisShard(object):
     def __init__(self, raw_shard):  # type: (Dict) -> None
         self._raw_shard = raw_shard
@@ -74,6 +217,203 @@ class KinesisRecord:
         return str(self.data)
 
 
+def epoch_millis(timestamp):  # type: (Optional[datetime]) -> int
+    """
+    Milliseconds since epoch of a record arrival timestamp (a naive UTC or an aware datetime), 0 for None
+    """
+    if timestamp is None:
+        return 0
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+
+_INT64 = struct.Struct("<q")
+
+
+def _int64_buffer(values):  # type: (List[int]) -> bytearray
+    return bytearray(struct.pack("<{}q".format(len(values)), *values))
+
+
+class ColumnarBatch(object):
+    """
+    A batch of records stored by column, for consumers processing whole batches with NumPy, pandas or Arrow:
+
+     - data: The data of every record concatenated into a single bytes buffer
+     - offsets: A bytearray of little endian int64 where the data of the record i is
+       data[offsets[i]:offsets[i + 1]]
+     - arrival_timestamps: A bytearray of little endian int64 approximate arrival timestamps, in milliseconds
+       since epoch (UTC)
+     - sequence_numbers, partition_keys: Lists of strings
+
+    It can also be used as a sequence of KinesisRecord, which are built on access.
+    """
+    def __init__(self,
+                 data,  # type: bytes
+                 offsets,  # type: bytearray
+                 arrival_timestamps,  # type: bytearray
+                 sequence_numbers,  # type: List[str]
+                 partition_keys,  # type: List[str]
+                 ):  # type: (...) -> None
+        self.data = data
+        self.offsets = offsets
+        self.arrival_timestamps = arrival_timestamps
+        self.sequence_numbers = sequence_numbers
+        self.partition_keys = partition_keys
+
+    @classmethod
+    def from_raw_records(cls, raw_records, record_filter=None):
+        # type: (List[Dict], Callable[[Dict], bool]) -> ColumnarBatch
+        """
+        Builds a batch from the raw GetRecords record dictionaries (those selected by record_filter, if given)
+        """
+        chunks = []  # type: List[bytes]
+        offsets = [0]  # type: List[int]
+        arrival_timestamps = []  # type: List[int]
+        sequence_numbers = []  # type: List[str]
+        partition_keys = []  # type: List[str]
+        position = 0
+        for raw_record in raw_records:
+            if record_filter is not None and not record_filter(raw_record):
+                continue
+            data = raw_record["Data"]
+            chunks.append(data)
+            position += len(data)
+            offsets.append(position)
+            arrival_timestamps.append(epoch_millis(raw_record.get("ApproximateArrivalTimestamp")))
+            sequence_numbers.append(raw_record["SequenceNumber"])
+            partition_keys.append(raw_record.get("PartitionKey", ""))
+        return cls(b"".join(chunks), _int64_buffer(offsets), _int64_buffer(arrival_timestamps), sequence_numbers,
+                   partition_keys)
+
+    def __len__(self):  # type: () -> int
+        return len(self.sequence_numbers)
+
+    def __getitem__(self, index):  # type: (int) -> KinesisRecord
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ColumnarBatch index out of range")
+        start, end = struct.unpack_from("<2q", self.offsets, index * _INT64.size)
+        arrival_timestamp, = _INT64.unpack_from(self.arrival_timestamps, index * _INT64.size)
+        return KinesisRecord.build(
+            sequence_number=self.sequence_numbers[index],
+            approximate_arrival_timestamp=datetime(1970, 1, 1) + timedelta(milliseconds=arrival_timestamp),
+            data=self.data[start:end],
+            partition_key=self.partition_keys[index],
+        )
+
+    def to_numpy(self):  # type: () -> Dict[str, Any]
+        """
+        Returns a dictionary of NumPy arrays by column. The data, offsets and arrival_timestamps
+        (as datetime64[ms]) arrays share the memory of the batch. Requires the numpy package.
+        """
+        import numpy
+
+        return {
+            "data": numpy.frombuffer(self.data, dtype=numpy.uint8),
+            "offsets": numpy.frombuffer(self.offsets, dtype="<i8"),
+            "arrival_timestamps": numpy.frombuffer(self.arrival_timestamps, dtype="<M8[ms]"),
+            "sequence_numbers": numpy.array(self.sequence_numbers, dtype=object),
+            "partition_keys": numpy.array(self.partition_keys, dtype=object),
+        }
+
+    def to_arrow(self):  # type: () -> Any
+        """
+        Returns a pyarrow.RecordBatch with "data" (large_binary), "approximate_arrival_timestamp",
+        "sequence_number" and "partition_key" columns. The data and timestamps columns share the memory
+        of the batch. Requires the pyarrow package.
+        """
+        import pyarrow
+
+        size = len(self)
+        data = pyarrow.Array.from_buffers(pyarrow.large_binary(), size, [
+            None, pyarrow.py_buffer(self.offsets), pyarrow.py_buffer(self.data)])
+        arrival_timestamps = pyarrow.Array.from_buffers(pyarrow.timestamp("ms", tz="UTC"), size, [
+            None, pyarrow.py_buffer(self.arrival_timestamps)])
+        return pyarrow.RecordBatch.from_arrays([
+            data,
+            arrival_timestamps,
+            pyarrow.array(self.sequence_numbers, type=pyarrow.string()),
+            pyarrow.array(self.partition_keys, type=pyarrow.string()),
+        ], names=["data", "approximate_arrival_timestamp", "sequence_number", "partition_key"])
+
+
+class RecordFilter(object):
+    """
+    Selects records by looking at the raw GetRecords response fields, so that the records it rejects are
+    discarded before building KinesisRecord instances (and before the caller decodes their data).
+
+    A record is selected when it matches all the given criteria:
+
+     - partition_keys: Its partition key is one of these
+     - partition_key_prefix: Its partition key starts with this prefix
+     - min_arrival_timestamp: It arrived at this datetime or later (boto3 returns timezone aware datetimes)
+     - data_prefix: Its data starts with these bytes
+     - data_regex: Its data matches this bytes regular expression (re.search)
+     - sample_rate: It belongs to this fraction of the records, chosen by hashing its sequence number,
+       so that the same records are selected every time they are read
+
+    Any other callable taking the raw record dictionary and returning a bool can be used as a filter.
+    """
+    def __init__(self,
+                 partition_keys=None,  # type: Iterable[str]
+                 partition_key_prefix=None,  # type: str
+                 min_arrival_timestamp=None,  # type: datetime
+                 data_prefix=None,  # type: bytes
+                 data_regex=None,  # type: Union[bytes, Pattern]
+                 sample_rate=None,  # type: float
+                 ):  # type: (...) -> None
+        self._partition_keys = frozenset(partition_keys) if partition_keys is not None else None
+        self._partition_key_prefix = partition_key_prefix
+        self._min_arrival_timestamp = min_arrival_timestamp
+        self._data_prefix = data_prefix
+        self._data_regex = re.compile(data_regex) if data_regex is not None else None
+        self._sample_threshold = None  # type: Optional[int]
+        if sample_rate is not None:
+            self._sample_threshold = int(sample_rate * 0x100000000)
+
+    def __call__(self, raw_record):  # type: (Dict) -> bool
+        partition_key = raw_record.get("PartitionKey")
+        if self._partition_keys is not None and partition_key not in self._partition_keys:
+            return False
+        if self._partition_key_prefix is not None and not (partition_key or "").startswith(self._partition_key_prefix):
+            return False
+        if self._min_arrival_timestamp is not None and \
+                raw_record["ApproximateArrivalTimestamp"] < self._min_arrival_timestamp:
+            return False
+        data = raw_record["Data"]
+        if self._data_prefix is not None and not data.startswith(self._data_prefix):
+            return False
+        if self._data_regex is not None and self._data_regex.search(data) is None:
+            return False
+        if self._sample_threshold is not None and \
+                crc32(raw_record["SequenceNumber"].encode("utf-8")) & 0xffffffff >= self._sample_threshold:
+            return False
+        return True
+
+
+class KinesisPutRecordsRequest:
+    def __init__(self, stream_name, records):  # type: (str, List[Tuple[str, bytes]])->None
+        self._stream_name = stream_name
+        self._records = records
+
+    def build(self):  # type: ()-> Dict
+        return {
+            "StreamName": self._stream_name,
+            "Records": [{"Data": data, "PartitionKey": key} for key, data in self._records],
+        }
+
+
+class KinesisPutRecordsResponse(object):
+    def __init__(self, raw_response):  # type: (Dict) -> None
+        self._raw_response = raw_response
+
+    @property
+    def failed_indexes(self):  # type: () -> List[int]
+        if not self._raw_response.get("FailedRecordCount"):
+            return []
+        return [i for i, record in enumerate(self._raw_response.get("Records", [])) if record.get("ErrorCode")]
+
+
 class KinesisPutRecordRequest:
     def __init__(self, stream_name, data, key):  # type: (str,bytes,str)->None
         self._stream_name = stream_name
@@ -88,6 +428,141 @@ class KinesisPutRecordRequest:
         }
 
 
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the last `window` calls of each Kinesis operation
+    """
+    def __init__(self, window=1000):  # type: (int) -> None
+        self._window = window
+        self._latencies = {}  # type: Dict[str, Deque[float]]
+        self._lock = Lock()
+
+    def record(self, operation, latency):  # type: (str, float) -> None
+        with self._lock:
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = self._latencies[operation] = deque(maxlen=self._window)
+            latencies.append(latency)
+
+    def percentile(self, operation, percentile, min_samples=1):  # type: (str, float, int) -> Optional[float]
+        """
+        The given percentile (0 to 100) of the recent latencies of the operation,
+        or None when there are less than `min_samples` of them
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(operation, ()))
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+    def stats(self):  # type: () -> Dict[str, Dict[str, Any]]
+        """
+        The number of recent calls and their p50, p99 and maximum latencies by operation
+        """
+        with self._lock:
+            operations = list(self._latencies)
+        stats = {}  # type: Dict[str, Dict[str, Any]]
+        for operation in operations:
+            stats[operation] = {
+                "calls": len(self._latencies[operation]),
+                "p50": self.percentile(operation, 50),
+                "p99": self.percentile(operation, 99),
+                "max": self.percentile(operation, 100),
+            }
+        return stats
+
+
+class AdaptiveBatchSize(object):
+    """
+    Tunes the GetRecords Limit of each shard, to be given as the `batch_size` of a KinesisStream.
+
+    The limit aims at `target_bytes` per call, from the average size of the records recently read from the
+    shard, and never allows more than `max_bytes` per call given the largest records recently read from it.
+    It is halved every time the shard read limits are exceeded (those calls return no records instead of
+    failing), reduced while calls take longer than `max_latency` seconds, and grows back after that.
+
+    The current settings of each shard are available with stats(), and the limit of each call is added
+    to the "get_records" tracer spans.
+    """
+    SIZE_SMOOTHING = 0.3
+    MIN_FACTOR = 1.0 / 64
+
+    def __init__(self,
+                 target_bytes=1024 * 1024,  # type: int
+                 max_bytes=8 * 1024 * 1024,  # type: int
+                 max_latency=2.0,  # type: float
+                 initial_limit=100,  # type: int
+                 min_limit=1,  # type: int
+                 max_limit=10000,  # type: int
+                 ):  # type: (...) -> None
+        self._target_bytes = target_bytes
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+        self._initial_limit = initial_limit
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._record_sizes = {}  # type: Dict[str, float]
+        self._largest_record_sizes = {}  # type: Dict[str, float]
+        self._factors = {}  # type: Dict[str, float]
+        self._lock = Lock()
+
+    def limit(self, shard_id):  # type: (str) -> int
+        """
+        The Limit to use for the next GetRecords call on the shard
+        """
+        with self._lock:
+            record_size = self._record_sizes.get(shard_id)
+            if record_size is None:
+                limit = float(self._initial_limit)
+            else:
+                limit = min(self._target_bytes / max(record_size, 1.0),
+                            self._max_bytes / max(self._largest_record_sizes[shard_id], 1.0))
+            limit *= self._factors.get(shard_id, 1.0)
+        return int(max(self._min_limit, min(self._max_limit, limit)))
+
+    def observe(self, shard_id, raw_records, latency):  # type: (str, List[Dict], float) -> None
+        """
+        Takes into account the records returned by a GetRecords call on the shard, and how long it took
+        """
+        with self._lock:
+            if raw_records:
+                sizes = [len(raw_record["Data"]) + len(raw_record.get("PartitionKey", ""))
+                         for raw_record in raw_records]
+                record_size = float(sum(sizes)) / len(sizes)
+                previous_size = self._record_sizes.get(shard_id, record_size)
+                self._record_sizes[shard_id] = previous_size + self.SIZE_SMOOTHING * (record_size - previous_size)
+                self._largest_record_sizes[shard_id] = max(
+                    max(sizes), (1 - self.SIZE_SMOOTHING) * self._largest_record_sizes.get(shard_id, 0))
+
+            factor = self._factors.get(shard_id, 1.0)
+            if self._max_latency is not None and latency > self._max_latency:
+                self._factors[shard_id] = max(self.MIN_FACTOR, factor * 0.75)
+            else:
+                self._factors[shard_id] = min(1.0, factor * 1.25)
+
+    def throttled(self, shard_id):  # type: (str) -> None
+        """
+        Takes into account a GetRecords call on the shard rejected for exceeding its read limits
+        """
+        with self._lock:
+            self._factors[shard_id] = max(self.MIN_FACTOR, self._factors.get(shard_id, 1.0) / 2)
+        logger.info("Reads throttled for shard {}, GetRecords limit lowered to {}".format(
+            shard_id, self.limit(shard_id)))
+
+    def stats(self):  # type: () -> Dict[str, Dict[str, Any]]
+        """
+        The current limit, average and largest record sizes and reduction factor of each shard
+        """
+        with self._lock:
+            shard_ids = set(self._record_sizes) | set(self._factors)
+        return {shard_id: {
+            "limit": self.limit(shard_id),
+            "record_size": self._record_sizes.get(shard_id),
+            "largest_record_size": self._largest_record_sizes.get(shard_id),
+            "factor": self._factors.get(shard_id, 1.0),
+        } for shard_id in shard_ids}
+
+
 class Stream(with_metaclass(abc.ABCMeta)):  # type: ignore
     def __init__(self, *args, **kwargs):
         self._stop = False
@@ -98,18 +573,38 @@ class Stream(with_metaclass(abc.ABCMeta)):  # type: ignore
         """
         self._stop = True
 
+    @property
+    def stopped(self):  # type: () -> bool
+        return self._stop
+
     @abc.abstractmethod
     def read(self):  # type: ()-> Generator[KinesisRecord, None, None]
         """
         Yields records from the stream, one at a time
         """
 
+    def read_batches(self):  # type: ()-> Generator[List[KinesisRecord], None, None]
+        """
+        Yields lists of records from the stream, as they are fetched
+        """
+        for record in self.read():
+            yield [record]
+
     @abc.abstractmethod
     def put(self, key, data):  # type: (str,bytes) -> None
         """
         Puts a record into a kinesis stream
         """
 
+    def put_records(self, records):  # type: (List[Tuple[str, bytes]]) -> List[Tuple[str, bytes]]
+        """
+        Puts several (key, data) records into a kinesis stream, returning the ones
+        (the same tuples that were given) that could not be written
+        """
+        for key, data in records:
+            self.put(key, data)
+        return []
+
 
 class KinesisStream(Stream):
     """
@@ -117,18 +612,45 @@ class KinesisStream(Stream):
     """
     TYPE = "kinesis"
 
+    PUT_RECORDS_MAX_COUNT = 500
+    PUT_RECORDS_MAX_BYTES = 5 * 1024 * 1024
+    HEDGE_MIN_SAMPLES = 100
+
     def __init__(self,
                  stream_name,  # type: str
                  region_name,  # type: str
                  aws_access_key_id=None,  # type: str
                  aws_secret_access_key=None,  # type: str
                  kinesis_client=None,  # type: Any
-                 batch_size=10000,  # type: int
+                 batch_size=10000,  # type: Union[int, AdaptiveBatchSize]
                  read_interval=1,  # type: int
                  shard_sync_interval=60,  # type: int
                  checkpointer=None,  # type: Checkpointer
-                 iterator_type="TRIM_HORIZON"  # type: str
+                 iterator_type="TRIM_HORIZON",  # type: str
+                 iterator_timestamp=None,  # type: datetime
+                 max_pool_connections=None,  # type: int
+                 tracer=None,  # type: Tracer
+                 connect_timeout=None,  # type: float
+                 read_timeout=None,  # type: float
+                 operation_timeouts=None,  # type: Dict[str, Tuple[float, float]]
+                 hedge_get_records=False,  # type: bool
+                 max_age=None,  # type: Union[timedelta, float]
+                 skip_ahead_factor=2,  # type: float
                  ):  # type: (...) -> None
+        """
+        connect_timeout and read_timeout (in seconds) apply to the calls of every operation, unless the
+        operation (such as "get_records" or "put_records") has its own (connect, read) timeouts in
+        operation_timeouts. Neither applies when a kinesis_client is given.
+
+        With hedge_get_records, a GetRecords call taking longer than the 99th percentile of the recent ones
+        is sent again, with the same iterator, through a separate connection pool, and the first response
+        is used. This costs about 1% more GetRecords calls.
+
+        With max_age (in seconds, or a timedelta), records that arrived longer ago are discarded before being
+        built, counted in `stale_records`, and checkpointed. When a shard is more than skip_ahead_factor times
+        max_age behind its tip, reading jumps straight to the records that arrived within max_age
+        (with an AT_TIMESTAMP iterator) instead of going through the whole backlog.
+        """
         super(KinesisStream, self).__init__()
         self._stream_name = stream_name
         self._batch_size = batch_size
@@ -136,60 +658,296 @@ class KinesisStream(Stream):
         self._shard_sync_interval = shard_sync_interval
         self._checkpointer = checkpointer  # type: Checkpointer
         self._iterator_type = iterator_type
+        self._iterator_timestamp = iterator_timestamp
 
         if self._checkpointer is None:
             self._checkpointer = InMemoryCheckpointer()
 
-        self._kinesis_client = kinesis_client
-        if self._kinesis_client is None:
-            self._kinesis_client = boto3.client("kinesis", region_name=region_name, aws_access_key_id=aws_access_key_id,
-                                                aws_secret_access_key=aws_secret_access_key)
+        self._tracer = tracer  # type: Tracer
+        if self._tracer is None:
+            self._tracer = Tracer()
+
+        self._client = kinesis_client
+        self._client_given = kinesis_client is not None
+        self._client_options = {
+            "region_name": region_name,
+            "aws_access_key_id": aws_access_key_id,
+            "aws_secret_access_key": aws_secret_access_key,
+            "max_pool_connections": max_pool_connections,
+            "connect_timeout": connect_timeout,
+            "read_timeout": read_timeout,
+        }  # type: Dict[str, Any]
+        self._operation_timeouts = operation_timeouts or {}
+        self._hedge_get_records = hedge_get_records
+        self._hedge_client = None  # type: Any
+        self._latencies = LatencyTracker()
+        self._max_age = max_age.total_seconds() if isinstance(max_age, timedelta) else max_age
+        self._skip_ahead_factor = skip_ahead_factor
+        self._stale_records = 0
+        self._closed_shards = set()  # type: Set[str]
 
         self._shards = []  # type: List[str]
         self._shards_sync_time = None  # type: Optional[datetime]
 
+    @property
+    def _kinesis_client(self):  # type: () -> Any
+        """
+        The boto3 client is only built (or taken from the shared ones) when it is first used,
+        so that creating streams does not pay for importing and configuring boto3
+        """
+        if self._client is None:
+            self._client = get_kinesis_client(**self._client_options)
+        return self._client
+
+    def _kinesis_client_for(self, operation):  # type: (str) -> Any
+        if self._client_given or operation not in self._operation_timeouts:
+            return self._kinesis_client
+        connect_timeout, read_timeout = self._operation_timeouts[operation]
+        return get_kinesis_client(**dict(self._client_options, connect_timeout=connect_timeout,
+                                         read_timeout=read_timeout))
+
+    @property
+    def stream_name(self):  # type: () -> str
+        return self._stream_name
+
+    @property
+    def read_interval(self):  # type: () -> int
+        return self._read_interval
+
+    @property
+    def checkpointer(self):  # type: () -> Checkpointer
+        return self._checkpointer
+
+    @property
+    def tracer(self):  # type: () -> Tracer
+        return self._tracer
+
+    def is_shard_closed(self, shard_id):  # type: (str) -> bool
+        """
+        Whether the shard has been closed (by resharding), the last batch read from it being its last one
+        """
+        return shard_id in self._closed_shards
+
+    @property
+    def stale_records(self):  # type: () -> int
+        """
+        The number of records discarded for being older than max_age
+        """
+        return self._stale_records
+
+    @property
+    def latencies(self):  # type: () -> LatencyTracker
+        """
+        The latencies of the GetRecords, PutRecord and PutRecords calls made by this stream
+        """
+        return self._latencies
+
     def put(self, key, data):  # type: (str, bytes) -> None
         kinesis_record = KinesisPutRecordRequest(stream_name=self._stream_name, data=data,
                                                  key=key)
-        self._kinesis_client.put_record(**kinesis_record.build())
+        self._timed("put_record", self._kinesis_client_for("put_record").put_record, kinesis_record.build())
 
-    def read(self):  # type: (...) -> Generator[KinesisRecord, None, None]
+    def put_records(self, records):  # type: (List[Tuple[str, bytes]]) -> List[Tuple[str, bytes]]
+        """
+        Puts records using as few PutRecords calls as the per call count and size limits allow
+        """
+        failed = []  # type: List[Tuple[str, bytes]]
+        chunk = []  # type: List[Tuple[str, bytes]]
+        chunk_size = 0
+        for record in records:
+            record_size = len(record[0]) + len(record[1])
+            if chunk and (len(chunk) == self.PUT_RECORDS_MAX_COUNT or
+                          chunk_size + record_size > self.PUT_RECORDS_MAX_BYTES):
+                failed.extend(self._put_records_chunk(chunk))
+                chunk, chunk_size = [], 0
+            chunk.append(record)
+            chunk_size += record_size
+        if chunk:
+            failed.extend(self._put_records_chunk(chunk))
+        return failed
+
+    def _put_records_chunk(self, records):  # type: (List[Tuple[str, bytes]]) -> List[Tuple[str, bytes]]
+        request = KinesisPutRecordsRequest(stream_name=self._stream_name, records=records)
+        response = KinesisPutRecordsResponse(
+            self._timed("put_records", self._kinesis_client_for("put_records").put_records, request.build()))
+        return [records[i] for i in response.failed_indexes]
+
+    def read(self, record_filter=None):  # type: (Callable[[Dict], bool]) -> Generator[KinesisRecord, None, None]
         """
         Yields records from Kinesis one at a time.
         The process starts by loading the last processed positions by shard,
         then pulls a batch of events from each shard in a round-robin fashion until stop() is called
+
+        When a record_filter is given (see RecordFilter) only the records it selects are yielded, but
+        the records it discards are checkpointed anyway.
         """
-        shard_iterators = {}  # type: Dict[str, str]
-        while not self._stop:
-            self._update_shard_iterators(shard_iterators)
-            for shard_id, iterator in shard_iterators.items():
-                records, next_iterator = self._get_records(iterator)
-                for record in records:
+        tracer = self._tracer
+        for shard_id, records, checkpoint_sequence in self._read_shard_batches(record_filter):
+            for record in records:
+                with tracer.span("handler", stream=self._stream_name, shard_id=shard_id):
                     yield record
+                with tracer.span("checkpoint", stream=self._stream_name, shard_id=shard_id):
                     self._checkpointer.checkpoint(shard_id, record.sequence_number)
-                shard_iterators[shard_id] = next_iterator
-            time.sleep(self._read_interval)
+            if checkpoint_sequence is not None and (not records or records[-1].sequence_number != checkpoint_sequence):
+                with tracer.span("checkpoint", stream=self._stream_name, shard_id=shard_id):
+                    self._checkpointer.checkpoint(shard_id, checkpoint_sequence)
 
-    def _update_shard_iterators(self, iterators):  # type: (Dict[str, str]) -> Dict[str, str]
-        for shard_id in self._get_active_shards():
-            if shard_id not in iterators:
-                sequence = self._checkpointer.get_checkpoint(shard_id)
-                iterators[shard_id] = self._get_shard_iterator(shard_id, sequence)
-        return iterators
+    def read_batches(self, record_filter=None):
+        # type: (Callable[[Dict], bool]) -> Generator[List[KinesisRecord], None, None]
+        """
+        Yields the records of each shard batch pulled from Kinesis, in the same way as read().
+        The position of a batch is checkpointed once the next batch is requested.
+        """
+        return self._read_batches(record_filter, _build_records)
 
-    def _get_records(self, iterator):  # type: (str) -> Tuple[List[KinesisRecord], str]
+    def read_columnar_batches(self, record_filter=None):
+        # type: (Callable[[Dict], bool]) -> Generator[ColumnarBatch, None, None]
+        """
+        Same as read_batches(), but each batch is a ColumnarBatch built straight from the GetRecords response
+        """
+        return self._read_batches(record_filter, ColumnarBatch.from_raw_records)
+
+    def _read_batches(self, record_filter, build_records):
+        # type: (Callable[[Dict], bool], Callable[..., Any]) -> Generator[Any, None, None]
+        tracer = self._tracer
+        for shard_id, records, checkpoint_sequence in self._read_shard_batches(record_filter, build_records):
+            if records:
+                with tracer.span("handler", stream=self._stream_name, shard_id=shard_id):
+                    yield records
+            if checkpoint_sequence is not None:
+                with tracer.span("checkpoint", stream=self._stream_name, shard_id=shard_id):
+                    self._checkpointer.checkpoint(shard_id, checkpoint_sequence)
+
+    def read_shard_batches(self, record_filter=None):  # type: (Callable[[Dict], bool]) -> _ShardBatches
+        """
+        Yields (shard id, records, checkpoint sequence) tuples for each batch pulled from Kinesis, in the same
+        way as read(), but without checkpointing them, which is left to the caller (see the `checkpointer`
+        property). Once the records are handled, the shard should be checkpointed at the checkpoint sequence,
+        which is the last record read by the batch (even if it was discarded by the record_filter), or None
+        if the batch read nothing.
+        """
+        return self._read_shard_batches(record_filter)
+
+    def _read_shard_batches(self, record_filter, build_records=_build_records):
+        # type: (Callable[[Dict], bool], Callable[..., Any]) -> _ShardBatches
+        """
+        See read_shard_batches(), the records are built from the raw record dictionaries with
+        `build_records(raw_records, record_filter)`
+        """
+        shard_iterators = ShardIterators(self)
+        tracer = self._tracer
+        self._closed_shards = set()
+        try:
+            while not self._stop:
+                with tracer.span("update_shard_iterators", stream=self._stream_name):
+                    shard_iterators.update()
+                for shard_id in shard_iterators.shard_ids():
+                    position = shard_iterators.position(shard_id)
+                    records = shard_iterators.get_records(shard_id, record_filter, build_records)
+                    if shard_iterators.is_closed(shard_id):
+                        self._closed_shards.add(shard_id)
+                    yield shard_id, records, _batch_position(position, shard_iterators.position(shard_id))
+                with tracer.span("sleep", stream=self._stream_name):
+                    time.sleep(self._read_interval)
+        finally:
+            with tracer.span("flush", stream=self._stream_name):
+                self._checkpointer.flush()
+
+    def _get_records(self,
+                     iterator,  # type: str
+                     shard_id=None,  # type: str
+                     record_filter=None,  # type: Callable[[Dict], bool]
+                     build_records=_build_records,  # type: Callable[..., Any]
+                     ):  # type: (...) -> Tuple[List[KinesisRecord], str, Optional[int], Optional[str]]
+        from botocore.exceptions import ClientError
+
+        adaptive_batch_size = self._batch_size if isinstance(self._batch_size, AdaptiveBatchSize) else None
+        limit = adaptive_batch_size.limit(shard_id) if adaptive_batch_size is not None else self._batch_size
+        start_time = time.time()
         try:
-            raw_response = self._kinesis_client.get_records(
-                ShardIterator=iterator,
-                Limit=self._batch_size,
-            )
+            with self._tracer.span("get_records", stream=self._stream_name, shard_id=shard_id, limit=limit):
+                raw_response = self._call_get_records({"ShardIterator": iterator, "Limit": limit})
         except ClientError as error:
+            code = error.response.get("Error", {}).get("Code")
+            if code == "ExpiredIteratorException":
+                raise_from(ExpiredIteratorException("Shard iterator expired {}".format(str(error))), error)
+            if code == "ProvisionedThroughputExceededException" and adaptive_batch_size is not None:
+                adaptive_batch_size.throttled(shard_id)
+                return build_records([], record_filter), iterator, None, None
             raise_from(StreamReadingException("Error reading from stream {}".format(str(error))), error)
-        records = []
         response = KinesisGetRecordsResponse(raw_response)
-        for record in response.records:
-            records.append(record)
-        return records, response.next_shard_iterator
+        if adaptive_batch_size is not None:
+            adaptive_batch_size.observe(shard_id, response.raw_records, time.time() - start_time)
+        with self._tracer.span("build_records", stream=self._stream_name, shard_id=shard_id):
+            records = build_records(response.raw_records, record_filter)
+        return records, response.next_shard_iterator, response.millis_behind_latest, response.last_sequence_number
+
+    def _max_age_filter(self, record_filter):  # type: (Callable[[Dict], bool]) -> Optional[_MaxAgeFilter]
+        if self._max_age is None:
+            return None
+        return _MaxAgeFilter(datetime.utcnow() - timedelta(seconds=self._max_age), record_filter)
+
+    def _skip_ahead(self, shard_iterators, shard_id):  # type: (ShardIterators, str) -> None
+        millis_behind_latest = shard_iterators.millis_behind_latest(shard_id)
+        if millis_behind_latest is None or shard_iterators.is_closed(shard_id) or \
+                millis_behind_latest <= self._skip_ahead_factor * self._max_age * 1000:
+            return
+        logger.info("Shard {} is {}s behind, skipping to the records of the last {}s".format(
+            shard_id, millis_behind_latest // 1000, self._max_age))
+        shard_iterators.skip_to(shard_id, datetime.utcnow() - timedelta(seconds=self._max_age))
+
+    def _timed(self, operation, function, request):  # type: (str, Callable[..., Any], Dict[str, Any]) -> Any
+        start_time = time.time()
+        try:
+            return function(**request)
+        finally:
+            self._latencies.record(operation, time.time() - start_time)
+
+    def _call_get_records(self, request):  # type: (Dict[str, Any]) -> Any
+        client = self._kinesis_client_for("get_records")
+        hedge_delay = None  # type: Optional[float]
+        if self._hedge_get_records:
+            hedge_delay = self._latencies.percentile("get_records", 99, min_samples=self.HEDGE_MIN_SAMPLES)
+        if hedge_delay is None:
+            return self._timed("get_records", client.get_records, request)
+
+        results = Queue()  # type: Queue
+
+        def call(client):  # type: (Any) -> None
+            try:
+                results.put((True, self._timed("get_records", client.get_records, request)))
+            except Exception as error:
+                results.put((False, error))
+
+        calls = [Thread(target=call, args=(client,), name="pynesis-get-records")]
+        calls[0].daemon = True
+        calls[0].start()
+        try:
+            succeeded, result = results.get(timeout=hedge_delay)
+        except Empty:
+            logger.debug("Hedging GetRecords call slower than {:.3f}s".format(hedge_delay))
+            calls.append(Thread(target=call, args=(self._get_hedge_client(),), name="pynesis-get-records-hedge"))
+            calls[1].daemon = True
+            calls[1].start()
+            succeeded, result = results.get()
+            if not succeeded:
+                succeeded, result = results.get()
+        if not succeeded:
+            raise result
+        return result
+
+    def _get_hedge_client(self):  # type: () -> Any
+        """
+        A client with its own connection pool, so that hedged calls do not reuse the connection of a slow call
+        """
+        if self._client_given:
+            return self._kinesis_client
+        if self._hedge_client is None:
+            options = dict(self._client_options)
+            if "get_records" in self._operation_timeouts:
+                options["connect_timeout"], options["read_timeout"] = self._operation_timeouts["get_records"]
+            self._hedge_client = _build_kinesis_client(**options)
+        return self._hedge_client
 
     def _get_active_shards(self):  # type: ()-> List[str]
         current_time = datetime.now()
@@ -206,21 +964,300 @@ class KinesisStream(Stream):
         self._shards_sync_time = current_time
         return self._shards
 
-    def _get_shard_iterator(self, shard_id, sequence=None):  # type: (str,str) -> str
+    def _get_shard_iterator(self, shard_id, sequence=None, timestamp=None):  # type: (str, str, datetime) -> str
         request = {
             "StreamName": self._stream_name,
             "ShardId": shard_id,
-        }
+        }  # type: Dict[str, Any]
 
         iterator_type = self._iterator_type
         if sequence is not None:
             iterator_type = "AFTER_SEQUENCE_NUMBER"
             request["StartingSequenceNumber"] = sequence
+        elif timestamp is not None:
+            iterator_type = "AT_TIMESTAMP"
+            request["Timestamp"] = timestamp
+        elif iterator_type == "AT_TIMESTAMP":
+            request["Timestamp"] = self._iterator_timestamp
         request["ShardIteratorType"] = iterator_type
         response = self._kinesis_client.get_shard_iterator(**request)
         return str(response.get("ShardIterator"))
 
 
+class ShardIterators(object):
+    """
+    Keeps the shard iterators used to read each active shard of a KinesisStream.
+
+    Shard iterators expire five minutes after being returned by Kinesis, which happens when the records of
+    a batch take that long to be processed. Iterators older than ITERATOR_MAX_AGE seconds, or rejected as
+    expired, are replaced by a new one starting right after the last record read from that shard, without
+    affecting the other shards. Closed shards (which have no next iterator) stop being read.
+    """
+    ITERATOR_MAX_AGE = 240
+
+    def __init__(self, stream):  # type: (KinesisStream) -> None
+        self._stream = stream
+        self._iterators = {}  # type: Dict[str, Tuple[str, datetime]]
+        self._positions = {}  # type: Dict[str, Optional[str]]
+        self._closed_shards = set()  # type: Set[str]
+        self._millis_behind_latest = {}  # type: Dict[str, Optional[int]]
+
+    def update(self):  # type: () -> None
+        """
+        Gets an iterator for each new active shard, starting after its checkpoint
+        """
+        for shard_id in self._stream._get_active_shards():
+            if shard_id not in self._iterators and shard_id not in self._closed_shards:
+                self._positions[shard_id] = self._stream.checkpointer.get_checkpoint(shard_id)
+                self.refresh(shard_id)
+
+    def shard_ids(self):  # type: () -> List[str]
+        return list(self._iterators)
+
+    def is_closed(self, shard_id):  # type: (str) -> bool
+        return shard_id in self._closed_shards
+
+    def position(self, shard_id):  # type: (str) -> Optional[str]
+        """
+        The sequence number of the last record read from the shard (or its checkpoint)
+        """
+        return self._positions.get(shard_id)
+
+    def millis_behind_latest(self, shard_id):  # type: (str) -> Optional[int]
+        """
+        How far the last batch read from the shard was from its tip, as reported by Kinesis
+        """
+        return self._millis_behind_latest.get(shard_id)
+
+    def refresh(self, shard_id):  # type: (str) -> None
+        """
+        Replaces the iterator of the shard with a new one starting right after the last record read
+        """
+        iterator = self._stream._get_shard_iterator(shard_id, self._positions.get(shard_id))
+        self._iterators[shard_id] = (iterator, datetime.now())
+
+    def skip_to(self, shard_id, timestamp):  # type: (str, datetime) -> None
+        """
+        Replaces the iterator of the shard with a new one starting at the records arrived at `timestamp`
+        (a naive UTC datetime), skipping those in between
+        """
+        iterator = self._stream._get_shard_iterator(shard_id, timestamp=timestamp)
+        self._iterators[shard_id] = (iterator, datetime.now())
+
+    def get_records(self,
+                    shard_id,  # type: str
+                    record_filter=None,  # type: Callable[[Dict], bool]
+                    build_records=_build_records,  # type: Callable[..., Any]
+                    ):  # type: (...) -> List[KinesisRecord]
+        """
+        Gets the next batch of records of the shard (those selected by record_filter, if given),
+        refreshing its iterator when it has expired. See KinesisStream._read_shard_batches() for build_records.
+
+        When the stream has a max_age, older records are discarded too, and the iterator skips ahead when the
+        shard is too far behind (see KinesisStream).
+        """
+        max_age_filter = self._stream._max_age_filter(record_filter)
+        if max_age_filter is not None:
+            record_filter = max_age_filter
+        iterator, obtained_time = self._iterators[shard_id]
+        if (datetime.now() - obtained_time).total_seconds() > self.ITERATOR_MAX_AGE:
+            logger.info("Refreshing iterator for shard {} before it expires".format(shard_id))
+            self.refresh(shard_id)
+            iterator = self._iterators[shard_id][0]
+
+        try:
+            records, next_iterator, millis_behind_latest, last_sequence = self._stream._get_records(
+                iterator, shard_id, record_filter, build_records)
+        except ExpiredIteratorException:
+            logger.info("Refreshing expired iterator for shard {}".format(shard_id))
+            self.refresh(shard_id)
+            records, next_iterator, millis_behind_latest, last_sequence = self._stream._get_records(
+                self._iterators[shard_id][0], shard_id, record_filter, build_records)
+
+        self._millis_behind_latest[shard_id] = millis_behind_latest
+        if last_sequence is not None:
+            self._positions[shard_id] = last_sequence
+        if next_iterator:
+            # A throttled call returns the same iterator, which keeps the time it was obtained at
+            if next_iterator != self._iterators[shard_id][0]:
+                self._iterators[shard_id] = (next_iterator, datetime.now())
+        else:
+            logger.info("Shard {} has been closed".format(shard_id))
+            del self._iterators[shard_id]
+            self._closed_shards.add(shard_id)
+        if max_age_filter is not None:
+            self._stream._stale_records += max_age_filter.stale
+            self._stream._skip_ahead(self, shard_id)
+        return records
+
+
+class EnhancedFanOutKinesisStream(KinesisStream):
+    """
+    Kinesis stream backend using enhanced fan-out (SubscribeToShard) instead of polling.
+
+    Each application registers its own stream consumer, so it gets a dedicated 2 MB/s per shard
+    read throughput which is not shared with other applications reading the same stream, and records
+    are pushed as soon as they arrive instead of waiting for the next GetRecords poll.
+
+    A background thread is kept subscribed to each active shard. Subscriptions expire after
+    5 minutes, and are renewed from the continuation sequence number of the last event received by that
+    thread (or from the last checkpoint, read when the thread is started, if no event has been received yet).
+    Checkpoints are only read and written from the thread calling read() or read_batches(), so the
+    Checkpointer needs no thread safety.
+    """
+    TYPE = "kinesis-fan-out"
+
+    CONSUMER_POLL_INTERVAL = 1
+    QUEUE_SIZE = 100
+    SUBSCRIBE_RETRY_INTERVAL = 1
+    MAX_SUBSCRIBE_RETRY_INTERVAL = 30
+
+    def __init__(self,
+                 stream_name,  # type: str
+                 region_name,  # type: str
+                 consumer_name,  # type: str
+                 **kwargs  # type: Any
+                 ):  # type: (...) -> None
+        super(EnhancedFanOutKinesisStream, self).__init__(stream_name, region_name, **kwargs)
+        self._consumer_name = consumer_name
+        self._consumer_arn = None  # type: Optional[str]
+        self._events = Queue(maxsize=self.QUEUE_SIZE)  # type: Queue
+        self._subscriptions = {}  # type: Dict[str, Thread]
+        self._unsubscribe = Event()
+
+    def _read_shard_batches(self, record_filter, build_records=_build_records):
+        # type: (Callable[[Dict], bool], Callable[..., Any]) -> _ShardBatches
+        # Each read gets its own queue and subscription threads, so that the threads of a previous read,
+        # which stop once they notice their unsubscribe event, can not revive or push stale events
+        self._events = events = Queue(maxsize=self.QUEUE_SIZE)
+        self._unsubscribe = unsubscribe = Event()
+        self._subscriptions = {}
+        self._closed_shards = set()
+        try:
+            while not self._stop:
+                self._update_subscriptions()
+                try:
+                    shard_id, raw_records, shard_ended = events.get(timeout=self._read_interval)
+                except Empty:
+                    continue
+                if isinstance(raw_records, Exception):
+                    raise_from(StreamReadingException("Error reading from stream {}".format(str(raw_records))),
+                               raw_records)
+                max_age_filter = self._max_age_filter(record_filter)
+                records = build_records(raw_records, max_age_filter or record_filter)
+                if max_age_filter is not None:
+                    self._stale_records += max_age_filter.stale
+                if shard_ended:
+                    self._closed_shards.add(shard_id)
+                yield shard_id, records, raw_records[-1].get("SequenceNumber") if raw_records else None
+        finally:
+            unsubscribe.set()
+            self._subscriptions = {}
+            self._checkpointer.flush()
+
+    def _get_consumer_arn(self):  # type: () -> str
+        from botocore.exceptions import ClientError
+
+        if self._consumer_arn is not None:
+            return self._consumer_arn
+
+        summary = self._kinesis_client.describe_stream_summary(StreamName=self._stream_name)
+        stream_arn = summary["StreamDescriptionSummary"]["StreamARN"]
+        try:
+            consumer = self._kinesis_client.register_stream_consumer(
+                StreamARN=stream_arn, ConsumerName=self._consumer_name)["Consumer"]
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") != "ResourceInUseException":
+                raise
+            consumer = self._kinesis_client.describe_stream_consumer(
+                StreamARN=stream_arn, ConsumerName=self._consumer_name)["ConsumerDescription"]
+
+        while consumer.get("ConsumerStatus") != "ACTIVE":
+            logger.info("Waiting for stream consumer {} to become active".format(self._consumer_name))
+            time.sleep(self.CONSUMER_POLL_INTERVAL)
+            consumer = self._kinesis_client.describe_stream_consumer(
+                ConsumerARN=consumer["ConsumerARN"])["ConsumerDescription"]
+
+        self._consumer_arn = consumer["ConsumerARN"]
+        return self._consumer_arn
+
+    def _update_subscriptions(self):  # type: () -> None
+        consumer_arn = self._get_consumer_arn()
+        for shard_id in self._get_active_shards():
+            if shard_id not in self._subscriptions:
+                # The checkpointer is only used from the reading thread, the subscription gets its starting sequence
+                sequence = self._checkpointer.get_checkpoint(shard_id)
+                thread = Thread(target=self._subscribe,
+                                args=(consumer_arn, shard_id, sequence, self._events, self._unsubscribe),
+                                name="pynesis-{}-{}".format(self._stream_name, shard_id))
+                thread.daemon = True
+                self._subscriptions[shard_id] = thread
+                thread.start()
+
+    def _subscribe(self,
+                   consumer_arn,  # type: str
+                   shard_id,  # type: str
+                   sequence,  # type: Optional[str]
+                   events,  # type: Queue
+                   unsubscribe,  # type: Event
+                   ):  # type: (...) -> None
+        from botocore.exceptions import ClientError
+
+        retry_interval = self.SUBSCRIBE_RETRY_INTERVAL
+        try:
+            while not unsubscribe.is_set():
+                starting_position = {"Type": self._iterator_type}  # type: Dict[str, Any]
+                if self._iterator_type == "AT_TIMESTAMP":
+                    starting_position["Timestamp"] = self._iterator_timestamp
+                if sequence is not None:
+                    starting_position = {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": sequence}
+                try:
+                    response = self._kinesis_client.subscribe_to_shard(
+                        ConsumerARN=consumer_arn, ShardId=shard_id, StartingPosition=starting_position)
+                except ClientError as error:
+                    if error.response.get("Error", {}).get("Code") != "ResourceInUseException":
+                        raise
+                    # The subscription of a previous read is still held until its event stream is released
+                    logger.info("Shard {} is still subscribed, retrying in {}s".format(shard_id, retry_interval))
+                    unsubscribe.wait(retry_interval)
+                    retry_interval = min(retry_interval * 2, self.MAX_SUBSCRIBE_RETRY_INTERVAL)
+                    continue
+                retry_interval = self.SUBSCRIBE_RETRY_INTERVAL
+
+                event_stream = response["EventStream"]
+                received_events = False
+                try:
+                    for raw_event in event_stream:
+                        if unsubscribe.is_set():
+                            return
+                        received_events = True
+                        event = KinesisSubscribeToShardEvent(raw_event)
+                        raw_records = event.raw_records
+                        if raw_records or event.shard_ended:
+                            self._publish(events, unsubscribe, (shard_id, raw_records, event.shard_ended))
+                        # Also moves forward on the events without records, which are sent as heartbeats
+                        sequence = event.continuation_sequence_number or sequence
+                        if event.shard_ended:
+                            return
+                finally:
+                    # Releases the subscription, so that the next read can subscribe to the shard again
+                    close = getattr(event_stream, "close", None)
+                    if close is not None:
+                        close()
+                if not received_events:
+                    unsubscribe.wait(self._read_interval)
+        except Exception as error:
+            self._publish(events, unsubscribe, (shard_id, error, False))
+
+    def _publish(self, events, unsubscribe, event):  # type: (Queue, Event, Tuple[str, Any, bool]) -> None
+        while not unsubscribe.is_set():
+            try:
+                events.put(event, timeout=self._read_interval)
+                return
+            except Full:
+                continue
+
+
 class DummyStream(Stream):
     """
     A dummy Stream implementation that always yields the same dummy record
@@ -0,0 +1,145 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from mock import MagicMock
+
+from pynesis import streams
+from pynesis.checkpointers import InMemoryCheckpointer
+from pynesis.tests.conftest import shared_memory_only
+
+
+def build_record(sequence_number, data=b"some data"):  # type: (int, bytes) -> streams.KinesisRecord
+    return streams.KinesisRecord.build(str(sequence_number), datetime(2017, 1, 1, 0, 0, 1), data, "key")
+
+
+@pytest.fixture
+def broker():
+    from pynesis.broker import SharedMemoryBroker
+
+    broker = SharedMemoryBroker(MagicMock(), "pynesis-test-{}".format(uuid.uuid4().hex[:8]), size=256)
+    broker.start()
+    yield broker
+    broker.close()
+
+
+@shared_memory_only
+def test_broker_subscribers(mocker, broker):
+    from pynesis.broker import SharedMemorySubscriber
+
+    broker.publish("shard1", [build_record(1), build_record(2)])
+    broker.publish("shard2", [build_record(3, b"")])
+
+    for subscriber in (SharedMemorySubscriber(broker._name), SharedMemorySubscriber(broker._name)):
+        mocker.patch("pynesis.broker.time.sleep", side_effect=lambda interval: subscriber.stop())
+        records = list(subscriber.read())
+        assert [record.sequence_number for record in records] == ["1", "2", "3"]
+        assert records[0].data == b"some data"
+        assert records[2].data == b""
+        assert records[0].approximate_arrival_timestamp == datetime(2017, 1, 1, 0, 0, 1)
+        assert subscriber.checkpointer.get_all_checkpoints() == {"shard1": "2", "shard2": "3"}
+
+
+@shared_memory_only
+def test_broker_subscriber_skips_checkpointed_records(mocker, broker):
+    from pynesis.broker import SharedMemorySubscriber
+
+    checkpointer = InMemoryCheckpointer()
+    checkpointer.checkpoint("shard1", "2")
+    subscriber = SharedMemorySubscriber(broker._name, checkpointer=checkpointer)
+    mocker.patch("pynesis.broker.time.sleep", side_effect=lambda interval: subscriber.stop())
+    broker.publish("shard1", [build_record(1), build_record(2), build_record(3)])
+
+    assert [record.sequence_number for record in subscriber.read()] == ["3"]
+
+
+@shared_memory_only
+def test_broker_buffer_wraps_around(mocker, broker):
+    from pynesis.broker import SharedMemorySubscriber
+
+    subscriber = SharedMemorySubscriber(broker._name)
+    mocker.patch("pynesis.broker.time.sleep", side_effect=lambda interval: subscriber.stop())
+    handled = []
+    generator = subscriber.read()
+
+    for sequence_number in range(1, 20):
+        broker.publish("shard1", [build_record(sequence_number, b"x" * sequence_number)])
+        record = next(generator)
+        handled.append(int(record.sequence_number))
+        assert record.data == b"x" * sequence_number
+
+    assert handled == list(range(1, 20))
+    assert subscriber.overruns == 0
+
+
+@shared_memory_only
+def test_broker_subscriber_overrun(mocker, broker):
+    from pynesis.broker import SharedMemorySubscriber
+
+    subscriber = SharedMemorySubscriber(broker._name)
+    mocker.patch("pynesis.broker.time.sleep", side_effect=lambda interval: subscriber.stop())
+    generator = subscriber.read()
+    broker.publish("shard1", [build_record(1)])
+    assert next(generator).sequence_number == "1"
+
+    broker.publish("shard1", [build_record(sequence_number) for sequence_number in range(2, 20)])
+    sequence_numbers = [int(record.sequence_number) for record in generator]
+
+    assert subscriber.overruns == 1
+    assert sequence_numbers == list(range(20 - len(sequence_numbers), 20))
+
+
+@shared_memory_only
+def test_broker_subscriber_reattaches_after_restart(mocker, broker):
+    from pynesis.broker import SharedMemoryBroker, SharedMemorySubscriber
+
+    subscriber = SharedMemorySubscriber(broker._name)
+    mocker.patch("pynesis.broker.time.sleep", side_effect=lambda interval: subscriber.stop())
+    generator = subscriber.read()
+    broker.publish("shard1", [build_record(1), build_record(2)])
+    assert next(generator).sequence_number == "1"
+
+    broker.close()
+    restarted_broker = SharedMemoryBroker(MagicMock(), broker._name, size=256)
+    restarted_broker.start()
+    try:
+        restarted_broker.publish("shard1", [build_record(2), build_record(3)])
+        assert [record.sequence_number for record in generator] == ["2", "3"]
+    finally:
+        restarted_broker.close()
+
+
+@shared_memory_only
+def test_broker_replaces_block_left_open(broker):
+    from pynesis.broker import SharedMemoryBroker
+
+    stale_ring = broker._ring
+    restarted_broker = SharedMemoryBroker(MagicMock(), broker._name, size=256)
+    restarted_broker.start()
+    try:
+        assert stale_ring.closed
+        assert not restarted_broker._ring.closed
+    finally:
+        restarted_broker.close()
+        broker._ring = None
+        broker._memory.close()
+        broker._memory = None
+
+
+@shared_memory_only
+def test_broker_run(mocker, kinesis_client):
+    from pynesis.broker import SharedMemoryBroker
+
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_client.get_records.return_value["Records"] = [
+        {"Data": b"one", "SequenceNumber": "1"}, {"Data": b"two", "SequenceNumber": "2"}]
+    checkpointer = InMemoryCheckpointer()
+    stream = streams.KinesisStream("test-stream", region_name="us-east-1", checkpointer=checkpointer,
+                                   kinesis_client=kinesis_client)
+    broker = SharedMemoryBroker(stream, "pynesis-test-{}".format(uuid.uuid4().hex[:8]))
+    publish = mocker.patch.object(broker, "publish", side_effect=lambda shard_id, records: stream.stop())
+
+    broker.run()
+
+    assert [record.sequence_number for record in publish.call_args[0][1]] == ["1", "2"]
+    assert checkpointer.get_checkpoint("shard1") == "2"
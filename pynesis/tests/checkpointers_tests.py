@@ -1,6 +1,9 @@
+import time
+
 from mock import call
 
-from pynesis.checkpointers import InMemoryCheckpointer, RedisCheckpointer
+from pynesis import checkpointers
+from pynesis.checkpointers import InMemoryCheckpointer, RedisCheckpointer, SQLiteCheckpointer
 from pynesis.tests.conftest import redis_only
 
 
@@ -28,3 +31,46 @@ def test_redis_checkpointer(mocker, redis_client):
     assert checkpointer.get_all_checkpoints() == {"myshard1": "sequence1", "myshard2": "sequence2"}
     assert redis_client.hset.mock_calls == [call("kinesis:sequences", "myshard1", "sequence1"),
                                             call("kinesis:sequences", "myshard2", "sequence2")]
+
+
+def test_sqlite_checkpointer(tmpdir):
+    path = str(tmpdir.join("checkpoints.db"))
+    checkpointer = SQLiteCheckpointer(path=path, commit_interval=0)
+    checkpointer.checkpoint("myshard1", "sequence1")
+    checkpointer.checkpoint("myshard2", "sequence2")
+    SQLiteCheckpointer(path=path, key="other-stream", commit_interval=0).checkpoint("myshard1", "other")
+
+    checkpointer = SQLiteCheckpointer(path=path)
+    assert checkpointer.get_checkpoint("myshard1") == "sequence1"
+    assert checkpointer.get_checkpoint("myshard2") == "sequence2"
+    assert checkpointer.get_all_checkpoints() == {"myshard1": "sequence1", "myshard2": "sequence2"}
+
+
+def test_sqlite_checkpointer_group_commit(mocker, tmpdir):
+    time_mock = mocker.patch(checkpointers.__name__ + ".time")
+    time_mock.time.return_value = 0
+    path = str(tmpdir.join("checkpoints.db"))
+    checkpointer = SQLiteCheckpointer(path=path, commit_interval=10)
+
+    checkpointer.checkpoint("myshard1", "sequence1")
+    checkpointer.checkpoint("myshard1", "sequence2")
+    assert SQLiteCheckpointer(path=path).get_all_checkpoints() == {}
+
+    time_mock.time.return_value = 10
+    checkpointer.checkpoint("myshard1", "sequence3")
+    checkpointer.checkpoint("myshard2", "sequence4")
+    assert SQLiteCheckpointer(path=path).get_all_checkpoints() == {"myshard1": "sequence3"}
+
+    checkpointer.flush()
+    assert SQLiteCheckpointer(path=path).get_all_checkpoints() == {"myshard1": "sequence3", "myshard2": "sequence4"}
+
+
+def test_sqlite_checkpointer_commits_idle_checkpoints(tmpdir):
+    path = str(tmpdir.join("checkpoints.db"))
+    checkpointer = SQLiteCheckpointer(path=path, commit_interval=0.05)
+
+    checkpointer.checkpoint("myshard1", "sequence1")
+    checkpointer.checkpoint("myshard1", "sequence2")
+    time.sleep(0.2)
+
+    assert SQLiteCheckpointer(path=path).get_all_checkpoints() == {"myshard1": "sequence2"}
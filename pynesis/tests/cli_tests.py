@@ -0,0 +1,112 @@
+import json
+from datetime import datetime
+from threading import Lock
+from zlib import crc32
+
+from six import StringIO
+
+from pynesis import cli
+
+
+class FakeKinesisClient(object):
+    """
+    In-memory stand-in of the boto3 kinesis client calls used by the command line tool
+    """
+    def __init__(self, shard_count=2):
+        self.shards = {"shard{}".format(i): [] for i in range(shard_count)}
+        self.put_records_calls = 0
+        self._lock = Lock()
+
+    def put_records(self, StreamName, Records):
+        shard_ids = sorted(self.shards)
+        with self._lock:  # Called from several threads by the put command
+            self.put_records_calls += 1
+            for record in Records:
+                shard = self.shards[shard_ids[crc32(record["PartitionKey"].encode("utf-8")) % len(shard_ids)]]
+                shard.append({"SequenceNumber": str(len(shard)), "PartitionKey": record["PartitionKey"],
+                              "Data": record["Data"], "ApproximateArrivalTimestamp": datetime(2017, 1, 1)})
+        return {"FailedRecordCount": 0, "Records": [{} for _ in Records]}
+
+    def get_paginator(self, operation):
+        assert operation == "describe_stream"
+        return self
+
+    def paginate(self, StreamName):
+        return [{"StreamDescription": {"Shards": [{"ShardId": shard_id} for shard_id in sorted(self.shards)]}}]
+
+    def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType, StartingSequenceNumber=None):
+        position = {"TRIM_HORIZON": 0, "LATEST": len(self.shards[ShardId])}.get(ShardIteratorType)
+        if ShardIteratorType == "AFTER_SEQUENCE_NUMBER":
+            position = int(StartingSequenceNumber) + 1
+        return {"ShardIterator": "{}:{}".format(ShardId, position)}
+
+    def get_records(self, ShardIterator, Limit):
+        shard_id, position = ShardIterator.split(":")
+        records = self.shards[shard_id][int(position):int(position) + Limit]
+        next_position = int(position) + len(records)
+        return {"Records": records, "NextShardIterator": "{}:{}".format(shard_id, next_position),
+                "MillisBehindLatest": 0 if next_position == len(self.shards[shard_id]) else 1000}
+
+
+def test_put_and_dump(tmpdir):
+    kinesis_client = FakeKinesisClient()
+    input_file = tmpdir.join("input.jsonl")
+    input_file.write("\n".join(json.dumps({"id": i, "message": "message{}".format(i)}) for i in range(25)))
+    dump_directory = tmpdir.mkdir("dump")
+
+    assert cli.main(["put", "my-stream", str(input_file), "--key-field", "id", "--batch-size", "10"],
+                    kinesis_client=kinesis_client) == 0
+    assert kinesis_client.put_records_calls == 3
+    assert cli.main(["dump", "my-stream", str(dump_directory)], kinesis_client=kinesis_client) == 0
+
+    dumped = [json.loads(line) for shard_file in sorted(dump_directory.listdir())
+              for line in shard_file.readlines()]
+    assert sorted(line["partition_key"] for line in dumped) == sorted(str(i) for i in range(25))
+    assert dumped[0]["approximate_arrival_timestamp"] == "2017-01-01T00:00:00"
+
+    replayed_client = FakeKinesisClient()
+    replay_file = tmpdir.join("replay.jsonl")
+    replay_file.write("".join(shard_file.read() for shard_file in sorted(dump_directory.listdir())))
+    assert cli.main(["put", "my-stream", str(replay_file)], kinesis_client=replayed_client) == 0
+    assert replayed_client.shards == kinesis_client.shards
+
+
+def test_tail(mocker):
+    mocker.patch("pynesis.streams.time")
+    kinesis_client = FakeKinesisClient(shard_count=1)
+    kinesis_client.put_records("my-stream", [{"PartitionKey": "key", "Data": b"before"}])
+    stream = cli.build_stream(cli.build_parser().parse_args(["tail", "my-stream"]), kinesis_client)
+    get_records = kinesis_client.get_records
+
+    def get_records_and_stop(**kwargs):
+        response = get_records(**kwargs)
+        if response["Records"]:
+            stream.stop()
+        else:
+            kinesis_client.put_records("my-stream", [{"PartitionKey": "key", "Data": b"after"}])
+        return response
+    kinesis_client.get_records = get_records_and_stop
+    output = StringIO()
+    reporter = mocker.MagicMock(spec=cli.ThroughputReporter)
+
+    cli.tail(stream, output, reporter=reporter)
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line["data"] for line in lines] == ["YWZ0ZXI="]
+    assert [sum(counts) for counts in zip(*(args for name, args, kwargs in reporter.add.mock_calls))] == [1, 5]
+
+
+def test_put_failures(mocker):
+    kinesis_client = FakeKinesisClient()
+    kinesis_client.put_records = mocker.MagicMock(side_effect=ValueError("Kinesis is down"))
+    stream = cli.build_stream(cli.build_parser().parse_args(["put", "my-stream", "-"]), kinesis_client)
+    lines = [json.dumps({"value": i}) for i in range(25)]
+
+    assert cli.put(stream, lines, batch_size=2, concurrency=2, retries=0) == 25
+
+
+def test_dump_failures(tmpdir, mocker):
+    kinesis_client = FakeKinesisClient()
+    kinesis_client.get_records = mocker.MagicMock(side_effect=ValueError("Kinesis is down"))
+
+    assert cli.main(["dump", "my-stream", str(tmpdir)], kinesis_client=kinesis_client) == 1
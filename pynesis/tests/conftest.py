@@ -50,12 +50,48 @@ def failing_kinesis_client():  # type: ()->MagicMock
     return mock
 
 
+@pytest.fixture
+def fan_out_kinesis_client(kinesis_client):  # type: (MagicMock)->MagicMock
+    kinesis_client.describe_stream_summary.return_value = {
+        "StreamDescriptionSummary": {"StreamARN": "arn:stream"}}
+    kinesis_client.register_stream_consumer.return_value = {
+        "Consumer": {"ConsumerARN": "arn:consumer", "ConsumerStatus": "CREATING"}}
+    kinesis_client.describe_stream_consumer.return_value = {
+        "ConsumerDescription": {"ConsumerARN": "arn:consumer", "ConsumerStatus": "ACTIVE"}}
+    kinesis_client.subscribe_to_shard.side_effect = [
+        {"EventStream": [  # Each line is a pushed event
+            {"SubscribeToShardEvent": {"Records": [
+                {"Data": b'{"_key": "1", "message": "message1"}', "SequenceNumber": "sequence1"},
+                {"Data": b'{"_key": "2", "message": "message2"}', "SequenceNumber": "sequence2"},
+            ], "ContinuationSequenceNumber": "sequence2"}},
+            {"SubscribeToShardEvent": {"Records": [], "ContinuationSequenceNumber": "continuation2"}},  # Heartbeat
+        ]},
+        {"EventStream": [
+            {"SubscribeToShardEvent": {"Records": [
+                {"Data": b'{"_key": "3", "message": "message3"}', "SequenceNumber": "sequence3"},
+            ], "ContinuationSequenceNumber": "sequence3", "ChildShards": [{"ShardId": "shard2"}]}},
+        ]},
+    ]
+    return kinesis_client
+
+
 @pytest.fixture
 def redis_client():  # type: ()->MagicMock
     mock = CopyingMock()
     return mock
 
 
+@pytest.fixture(autouse=True)
+def kinesis_clients(mocker):
+    """
+    Isolates each test from the boto3 clients and django streams cached by previous tests
+    """
+    mocker.patch.dict("pynesis.streams._kinesis_clients", clear=True)
+    if module_installed("django"):
+        from pynesis.djangoutils import registry
+        registry.clear()
+
+
 @pytest.fixture
 def examples(mocker, kinesis_client, redis_client):
     mocker.patch("boto3.client", return_value=kinesis_client)
@@ -74,3 +110,8 @@ def module_installed(module):  # type: (str) -> bool
 
 django_only = pytest.mark.skipif(not module_installed("django"), reason="requires django")
 redis_only = pytest.mark.skipif(not module_installed("redis"), reason="requires redis")
+opentelemetry_only = pytest.mark.skipif(not module_installed("opentelemetry"), reason="requires opentelemetry")
+numpy_only = pytest.mark.skipif(not module_installed("numpy"), reason="requires numpy")
+shared_memory_only = pytest.mark.skipif(not module_installed("multiprocessing.shared_memory"),
+                                        reason="requires python 3.8")
+pyarrow_only = pytest.mark.skipif(not module_installed("pyarrow"), reason="requires pyarrow")
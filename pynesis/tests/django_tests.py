@@ -1,9 +1,21 @@
+from typing import List  # noqa
+
 import pytest
-from mock import MagicMock
+from mock import MagicMock, call
 
 from pynesis import checkpointers, streams
 from pynesis.tests.conftest import django_only
 
+consumed_records = []  # type: List[bytes]
+
+
+def consume_record(record):
+    consumed_records.append(record.data)
+
+
+def fail_consuming_record(record):
+    raise ValueError("Unexpected record")
+
 
 @django_only
 @pytest.mark.django_db
@@ -61,3 +73,178 @@ def test_get_stream_django(mocker, settings):
     assert isinstance(checkpointer, checkpointers.Checkpointer)
     assert kinesis_class_mock.call_args[1]["stream_name"] == "my-stream-1"
     assert kinesis_class_mock.call_args[1]["region_name"] == "us-east-1"
+
+
+@django_only
+def test_get_stream_django_registry(mocker, settings):
+    from pynesis.djangoutils import get_stream
+
+    settings.PYNESIS_CONFIG = {
+        "stream1": {"BACKEND_OPTIONS": {"fake_values": [b"one"]}},
+        "stream2": {"BACKEND_OPTIONS": {"fake_values": [b"two"]}},
+    }
+
+    stream1 = get_stream("stream1")
+    stream2 = get_stream("stream2")
+
+    assert stream1 is not stream2
+    assert get_stream("stream1") is stream1
+    assert next(stream2.read()).data == b"two"
+
+
+@django_only
+def test_get_stream_django_shares_kinesis_clients(mocker, settings):
+    from pynesis.djangoutils import get_stream
+
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "BACKEND": "pynesis.streams.KinesisStream",
+            "BACKEND_OPTIONS": {"stream_name": "my-stream-1", "region_name": "us-east-1", "max_pool_connections": 4},
+        },
+        "stream2": {
+            "BACKEND": "pynesis.streams.KinesisStream",
+            "BACKEND_OPTIONS": {"stream_name": "my-stream-2", "region_name": "us-east-1", "max_pool_connections": 4},
+        },
+    }
+    client_mock = mocker.patch("boto3.client")
+
+    get_stream("stream1").put("key", b"data")
+    get_stream("stream2").put("key", b"data")
+
+    assert len(client_mock.call_args_list) == 1
+    assert client_mock.call_args[1]["config"].max_pool_connections == 4
+    assert len(client_mock.return_value.put_record.mock_calls) == 2
+
+
+@django_only
+@pytest.mark.django_db
+def test_outbox_drainer(mocker, settings):
+    from pynesis.djangoutils import OutboxDrainer, put_outbox
+    from pynesis.models import OutboxRecord
+
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "BACKEND": "pynesis.streams.KinesisStream",
+            "BACKEND_OPTIONS": {"stream_name": "my-stream-1", "region_name": "us-east-1"},
+        },
+    }
+    client_mock = mocker.patch("boto3.client").return_value
+    client_mock.put_records.return_value = {"FailedRecordCount": 1, "Records": [{}, {"ErrorCode": "Throttled"}]}
+
+    put_outbox("stream1", "key1", b"data1")
+    put_outbox("stream1", "key2", b"data2")
+
+    assert OutboxDrainer().drain_once() == 1
+    assert client_mock.put_records.mock_calls == [
+        call(StreamName="my-stream-1", Records=[{"Data": b"data1", "PartitionKey": "key1"},
+                                                {"Data": b"data2", "PartitionKey": "key2"}])]
+    assert [row.key for row in OutboxRecord.objects.all()] == ["key2"]
+
+
+@django_only
+@pytest.mark.django_db
+def test_outbox_drainer_publishes_each_stream_separately(mocker, settings):
+    from pynesis.djangoutils import OutboxDrainer, put_outbox
+    from pynesis.models import OutboxRecord
+
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "BACKEND": "pynesis.streams.KinesisStream",
+            "BACKEND_OPTIONS": {"stream_name": "my-stream-1", "region_name": "us-east-1"},
+        },
+        "stream2": {
+            "BACKEND": "pynesis.streams.KinesisStream",
+            "BACKEND_OPTIONS": {"stream_name": "my-stream-2", "region_name": "us-east-1"},
+        },
+    }
+
+    def put_records(StreamName, Records):
+        if StreamName == "my-stream-2":
+            raise ValueError("Kinesis is down")
+        return {"FailedRecordCount": 0, "Records": [{} for _ in Records]}
+    mocker.patch("boto3.client").return_value.put_records.side_effect = put_records
+
+    put_outbox("stream1", "key1", b"data1")
+    put_outbox("stream2", "key2", b"data2")
+    put_outbox("stream1", "key3", b"data3")
+
+    with pytest.raises(ValueError):
+        OutboxDrainer().drain_once()
+    assert [row.key for row in OutboxRecord.objects.all()] == ["key2"]
+
+
+@django_only
+def test_pynesis_consume_command(mocker, settings):
+    from django.core.management import call_command
+
+    mocker.patch(streams.__name__ + ".time")
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "HANDLER": "pynesis.tests.django_tests.consume_record",
+            "BACKEND_OPTIONS": {"fake_values": [b"one", b"two"], "loop": False},
+        },
+        "stream2": {
+            "HANDLER": "pynesis.tests.django_tests.consume_record",
+            "BACKEND_OPTIONS": {"fake_values": [b"three"], "loop": False},
+        },
+        "stream3": {
+            "BACKEND_OPTIONS": {"fake_values": [b"four"], "loop": False},
+        },
+    }
+    del consumed_records[:]
+
+    call_command("pynesis_consume")
+
+    assert sorted(consumed_records) == [b"one", b"three", b"two"]
+
+
+@django_only
+def test_pynesis_consume_command_errors(mocker, settings):
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+
+    mocker.patch(streams.__name__ + ".time")
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "HANDLER": "pynesis.tests.django_tests.fail_consuming_record",
+            "BACKEND_OPTIONS": {"fake_values": [b"one"], "loop": False},
+        },
+        "stream2": {
+            "BACKEND_OPTIONS": {"fake_values": [b"two"], "loop": False},
+        },
+    }
+
+    with pytest.raises(CommandError):
+        call_command("pynesis_consume", "stream2")
+    with pytest.raises(CommandError):
+        call_command("pynesis_consume", "stream1")
+
+
+@django_only
+def test_pynesis_consume_command_workers(mocker, settings, caplog):
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+
+    mocker.patch(streams.__name__ + ".time")
+    # The workers run in this process, one after the other, and their exit status is reported to the parent
+    os_mock = mocker.patch("pynesis.management.commands.pynesis_consume.os")
+    os_mock.fork.return_value = 0
+    os_mock.waitpid.side_effect = lambda pid, options: (pid, os_mock._exit.mock_calls.pop(0)[1][0] << 8)
+    settings.PYNESIS_CONFIG = {
+        "stream1": {
+            "HANDLER": "pynesis.tests.django_tests.fail_consuming_record",
+            "BACKEND_OPTIONS": {"fake_values": [b"one"], "loop": False},
+        },
+        "stream2": {
+            "HANDLER": "pynesis.tests.django_tests.consume_record",
+            "BACKEND_OPTIONS": {"fake_values": [b"two"], "loop": False},
+        },
+    }
+    del consumed_records[:]
+
+    with pytest.raises(CommandError, match="1 workers failed"):
+        call_command("pynesis_consume", "--workers", "2")
+
+    assert consumed_records == [b"two"]
+    assert [record.getMessage() for record in caplog.records if record.exc_info] == [
+        "Error consuming stream stream1, stopping all streams", "Worker 0 failed"]
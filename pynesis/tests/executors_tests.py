@@ -0,0 +1,85 @@
+from datetime import datetime
+from threading import Event
+
+import pytest
+from mock import MagicMock, call
+
+from pynesis import streams
+from pynesis.checkpointers import Checkpointer
+from pynesis.executors import PartitionKeyExecutor
+
+
+@pytest.fixture
+def keyed_kinesis_client(kinesis_client):  # type: (MagicMock)->MagicMock
+    responses = [{
+        "Records": [
+            {"Data": b"a1", "SequenceNumber": "sequence1", "PartitionKey": "a"},
+            {"Data": b"b1", "SequenceNumber": "sequence2", "PartitionKey": "b"},
+            {"Data": b"a2", "SequenceNumber": "sequence3", "PartitionKey": "a"},
+        ],
+        "NextShardIterator": "iterator2"}]
+    kinesis_client.get_records.side_effect = lambda **kwargs: (
+        responses.pop() if responses else {"Records": [], "NextShardIterator": "iterator2"})
+    return kinesis_client
+
+
+def build_stream(kinesis_client):  # type: (MagicMock) -> streams.KinesisStream
+    checkpointer_mock = MagicMock(spec=Checkpointer)
+    checkpointer_mock.get_checkpoint.return_value = None
+    return streams.KinesisStream(stream_name="test-stream", region_name="us-east-1", read_interval=0,
+                                 kinesis_client=kinesis_client, checkpointer=checkpointer_mock)
+
+
+def test_partition_key_executor(keyed_kinesis_client):
+    stream = build_stream(keyed_kinesis_client)
+    b1_handled = Event()
+    handled = []
+
+    def handler(record):
+        if record.data == b"a1":
+            assert b1_handled.wait(5)
+        handled.append(record.data)
+        if record.data == b"b1":
+            b1_handled.set()
+        if record.data == b"a2":
+            executor.stop()
+
+    executor = PartitionKeyExecutor(stream, handler, max_workers=4)
+    executor.run()
+
+    assert handled == [b"b1", b"a1", b"a2"]
+    assert stream.checkpointer.checkpoint.mock_calls == [
+        call("shard1", "sequence2"),
+        call("shard1", "sequence3"),
+    ]
+    assert stream.checkpointer.flush.mock_calls
+
+
+def test_partition_key_executor_errors(keyed_kinesis_client):
+    stream = build_stream(keyed_kinesis_client)
+
+    def handler(record):
+        if record.data == b"a1":
+            raise ValueError("Unexpected record")
+
+    executor = PartitionKeyExecutor(stream, handler, max_workers=4)
+    with pytest.raises(ValueError):
+        executor.run()
+
+    assert stream.checkpointer.checkpoint.mock_calls == []
+
+
+def test_partition_key_executor_checkpoints_discarded_records(keyed_kinesis_client):
+    stream = build_stream(keyed_kinesis_client)
+    record = streams.KinesisRecord.build("sequence1", datetime(2017, 1, 1), b"a1", "a")
+
+    def read_shard_batches():
+        yield "shard1", [record], "sequence2"
+        yield "shard1", [], "sequence3"
+    stream.read_shard_batches = read_shard_batches
+    handled = []
+
+    PartitionKeyExecutor(stream, lambda record: handled.append(record.data), max_workers=2).run()
+
+    assert handled == [b"a1"]
+    assert stream.checkpointer.checkpoint.mock_calls[-1] == call("shard1", "sequence3")
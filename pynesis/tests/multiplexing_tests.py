@@ -0,0 +1,85 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import count
+
+from mock import MagicMock
+from typing import Any  # noqa
+
+from pynesis import multiplexing, streams
+from pynesis.checkpointers import InMemoryCheckpointer
+
+
+def build_stream(name, **kwargs):  # type: (str, Any) -> streams.KinesisStream
+    kinesis_client = MagicMock()
+    kinesis_client.get_paginator.return_value.paginate.return_value = [
+        {"StreamDescription": {"Shards": [{"ShardId": "shard1"}, {"ShardId": "shard2"}]}}]
+    kinesis_client.get_shard_iterator.return_value = {"ShardIterator": "iterator1"}
+    kinesis_client.get_records.return_value = {
+        "Records": [{"Data": name.encode("utf-8"), "SequenceNumber": "sequence1"},
+                    {"Data": name.encode("utf-8"), "SequenceNumber": "sequence2"}],
+        "NextShardIterator": "iterator2"}
+    return streams.KinesisStream(stream_name=name, region_name="us-east-1", kinesis_client=kinesis_client,
+                                 checkpointer=InMemoryCheckpointer(), **kwargs)
+
+
+def test_multi_stream_reader(mocker):
+    time_mock = mocker.patch(multiplexing.__name__ + ".time")
+    time_mock.time.side_effect = count()
+    stream1 = build_stream("stream1")
+    stream2 = build_stream("stream2")
+
+    reader = multiplexing.MultiStreamReader([stream1, stream2])
+    generator = reader.read()
+    records = [next(generator) for _ in range(8)]
+    reader.stop()
+    assert list(generator) == []
+
+    assert records[0][0] == "stream1"
+    assert records[0][1].data == b"stream1"
+    assert Counter(name for name, record in records) == {"stream1": 4, "stream2": 4}
+    assert stream1.checkpointer.get_all_checkpoints() == {"shard1": "sequence2", "shard2": "sequence2"}
+    assert stream2.checkpointer.get_all_checkpoints() == {"shard1": "sequence2", "shard2": "sequence2"}
+
+
+def test_multi_stream_reader_max_age(mocker):
+    time_mock = mocker.patch(multiplexing.__name__ + ".time")
+    time_mock.time.side_effect = count()
+    stream = build_stream("stream1", max_age=60)
+    stream._kinesis_client.get_records.return_value["Records"][1]["ApproximateArrivalTimestamp"] = \
+        datetime.utcnow() - timedelta(hours=1)
+
+    reader = multiplexing.MultiStreamReader([stream])
+    generator = reader.read()
+    records = [next(generator) for _ in range(2)]
+    reader.stop()
+    assert list(generator) == []
+
+    assert [record.sequence_number for name, record in records] == ["sequence1", "sequence1"]
+    assert stream.stale_records == 2
+    assert stream.checkpointer.get_all_checkpoints() == {"shard1": "sequence2", "shard2": "sequence2"}
+
+
+def test_multi_stream_reader_weights(mocker):
+    time_mock = mocker.patch(multiplexing.__name__ + ".time")
+    time_mock.time.side_effect = count()
+    stream1 = build_stream("stream1")
+    stream2 = build_stream("stream2")
+
+    reader = multiplexing.MultiStreamReader([stream1, stream2], weights={"stream1": 3})
+    generator = reader.read()
+    records = [next(generator) for _ in range(16)]
+
+    assert Counter(name for name, record in records) == {"stream1": 12, "stream2": 4}
+
+
+def test_rate_limiter(mocker):
+    time_mock = mocker.patch(multiplexing.__name__ + ".time")
+    time_mock.time.return_value = 0
+    limiter = multiplexing.RateLimiter(calls_per_second=2)
+
+    limiter.acquire()
+    limiter.acquire()
+    time_mock.sleep.side_effect = lambda seconds: setattr(time_mock.time, "return_value", 0 + seconds)
+    limiter.acquire()
+
+    assert time_mock.sleep.call_args_list[0][0] == (0.5,)
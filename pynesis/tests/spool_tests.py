@@ -0,0 +1,111 @@
+import os
+from datetime import datetime
+
+import pytest
+from mock import MagicMock
+
+from pynesis import streams
+from pynesis.checkpointers import InMemoryCheckpointer
+from pynesis.spool import Spool, SpoolReplayer, _segment_numbers, _segment_path
+
+
+def build_record(sequence_number, data=b"some data"):  # type: (str, bytes) -> streams.KinesisRecord
+    return streams.KinesisRecord.build(sequence_number, datetime(2017, 1, 1, 0, 0, 1, 500000), data, "key")
+
+
+def test_spool_replay(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.append("shard1", [build_record("1"), build_record("2", b"")])
+    spool.append("shard2", [build_record("3")])
+    spool.close()
+
+    handled = []
+    replayer = SpoolReplayer(str(tmpdir))
+    count = replayer.replay(lambda shard_id, record: handled.append((shard_id, record)))
+
+    assert count == 3
+    assert [(shard_id, record.sequence_number, record.data) for shard_id, record in handled] == [
+        ("shard1", "1", b"some data"), ("shard1", "2", b""), ("shard2", "3", b"some data")]
+    assert handled[0][1].partition_key == "key"
+    assert handled[0][1].approximate_arrival_timestamp == datetime(2017, 1, 1, 0, 0, 1, 500000)
+    assert replayer.position == (0, 3)
+    assert replayer.replay(lambda shard_id, record: None) == 0
+
+
+def test_spool_replay_continues_after_failure(tmpdir):
+    spool = Spool(str(tmpdir), segment_max_bytes=1)
+    for sequence_number in ("1", "2", "3"):
+        spool.append("shard1", [build_record(sequence_number)])
+    spool.close()
+    handled = []
+
+    def handler(shard_id, record):
+        if record.sequence_number == "2":
+            raise ValueError("Sink is down")
+        handled.append(record.sequence_number)
+
+    replayer = SpoolReplayer(str(tmpdir))
+    with pytest.raises(ValueError):
+        replayer.replay(handler)
+
+    assert replayer.position == (0, 1)
+    assert replayer.replay(lambda shard_id, record: handled.append(record.sequence_number)) == 2
+    assert handled == ["1", "2", "3"]
+
+
+def test_spool_recovers_truncated_segment(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.append("shard1", [build_record("1"), build_record("2")])
+    spool.close()
+    log_path = _segment_path(str(tmpdir), 0, "log")
+    with open(log_path, "r+b") as log:
+        log.truncate(os.path.getsize(log_path) - 1)
+
+    spool = Spool(str(tmpdir))
+    spool.append("shard1", [build_record("3")])
+    spool.close()
+
+    sequence_numbers = [record.sequence_number for position, shard_id, record in SpoolReplayer(str(tmpdir)).read()]
+    assert sequence_numbers == ["1", "3"]
+
+
+def test_spool_retention(tmpdir):
+    spool = Spool(str(tmpdir), segment_max_bytes=1, max_bytes=200)
+    for sequence_number in range(10):
+        spool.append("shard1", [build_record(str(sequence_number), b"x" * 50)])
+    spool.close()
+
+    assert _segment_numbers(str(tmpdir)) == [7, 8, 9]
+
+    spool = Spool(str(tmpdir), segment_max_bytes=1, max_age=-1)
+    spool.append("shard1", [build_record("10")])
+    spool.close()
+    assert _segment_numbers(str(tmpdir)) == [10]
+
+
+def test_spool_consume_checkpoints_spooled_batches(mocker, tmpdir, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer = InMemoryCheckpointer()
+    stream = streams.KinesisStream("test-stream", region_name="us-east-1", checkpointer=checkpointer,
+                                   kinesis_client=kinesis_client)
+    spool = Spool(str(tmpdir))
+    spool.append = MagicMock(side_effect=lambda shard_id, records: stream.stop())
+
+    spool.consume(stream)
+
+    assert [record.sequence_number for record in spool.append.call_args[0][1]] == [
+        "sequence1", "sequence2", "sequence3"]
+    assert checkpointer.get_checkpoint("shard1") == "sequence3"
+
+
+def test_spool_consume_checkpoints_discarded_records(tmpdir):
+    checkpointer = InMemoryCheckpointer()
+    stream = MagicMock(checkpointer=checkpointer)
+    stream.read_shard_batches.return_value = [("shard1", [build_record("1")], "2"), ("shard1", [], "3")]
+    spool = Spool(str(tmpdir))
+
+    spool.consume(stream)
+    spool.close()
+
+    assert [record.sequence_number for position, shard_id, record in SpoolReplayer(str(tmpdir)).read()] == ["1"]
+    assert checkpointer.get_checkpoint("shard1") == "3"
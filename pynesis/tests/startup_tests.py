@@ -0,0 +1,62 @@
+import subprocess
+import sys
+
+from pynesis import streams
+
+IMPORT_TIME_BUDGET = 0.5
+
+IMPORT_SCRIPT = """
+import sys
+import time
+
+start = time.time()
+import pynesis.streams, pynesis.checkpointers, pynesis.multiplexing, pynesis.djangoutils  # noqa
+elapsed = time.time() - start
+print(elapsed)
+print(" ".join(module for module in ("boto3", "botocore", "django.db", "redis") if module in sys.modules))
+"""
+
+FIRST_CALL_TIME_BUDGET = 1
+
+FIRST_CALL_SCRIPT = """
+import time
+
+from pynesis.streams import KinesisStream
+
+stream = KinesisStream("test-stream", region_name="us-east-1", aws_access_key_id="key", aws_secret_access_key="secret")
+start = time.time()
+stream._kinesis_client
+print(time.time() - start)
+"""
+
+
+def test_import_time():
+    """
+    Importing pynesis must not load boto3, botocore or django, which are only needed
+    once a Kinesis client or a Django model is used
+    """
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT]).decode("utf-8").split("\n")
+    elapsed, loaded_modules = float(output[0]), output[1]
+
+    assert loaded_modules == ""
+    assert elapsed < IMPORT_TIME_BUDGET
+
+
+def test_kinesis_client_is_built_on_first_call(mocker):
+    client_mock = mocker.patch("boto3.client")
+
+    kinesis_backend = streams.KinesisStream(stream_name="test-stream", region_name="us-east-1")
+    assert client_mock.mock_calls == []
+
+    kinesis_backend.put(key="123", data=b"some bytes")
+    kinesis_backend.put(key="123", data=b"some bytes")
+    assert len(client_mock.call_args_list) == 1
+
+
+def test_first_call_time():
+    """
+    The first Kinesis call pays for importing boto3 and building the client, which must stay within budget
+    """
+    elapsed = float(subprocess.check_output([sys.executable, "-c", FIRST_CALL_SCRIPT]).decode("utf-8"))
+
+    assert elapsed < FIRST_CALL_TIME_BUDGET
@@ -1,8 +1,15 @@
+import struct
+from datetime import datetime, timedelta
+from threading import Event, current_thread
+
 import pytest
+from botocore.exceptions import ClientError
+from dateutil.tz import tzutc
 from mock import MagicMock, call
 
-from pynesis.checkpointers import Checkpointer
+from pynesis.checkpointers import Checkpointer, InMemoryCheckpointer
 from .. import streams
+from .conftest import numpy_only, pyarrow_only
 
 
 def test_kinesis_record():
@@ -12,6 +19,12 @@ def test_kinesis_record():
     assert record.data == b'{"some": "json"}'
 
 
+def test_epoch_millis():
+    assert streams.epoch_millis(datetime(1970, 1, 1, 0, 0, 1, 500000)) == 1500
+    assert streams.epoch_millis(datetime(1970, 1, 1, 1, tzinfo=tzutc())) == 3600000
+    assert streams.epoch_millis(None) == 0
+
+
 def test_dummy_backend(mocker):
     time_mock = mocker.patch(streams.__name__ + ".time")
     dummy_backend = streams.DummyStream(
@@ -62,6 +75,22 @@ def test_kinesis_backend(kinesis_client):
     ]
 
 
+def test_kinesis_backend_at_timestamp(kinesis_client):
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        iterator_type="AT_TIMESTAMP",
+        iterator_timestamp=datetime(2017, 1, 1),
+        kinesis_client=kinesis_client,
+    )
+    next(kinesis_backend.read())
+
+    assert kinesis_client.get_shard_iterator.mock_calls == [
+        call(ShardId="shard1", ShardIteratorType="AT_TIMESTAMP", Timestamp=datetime(2017, 1, 1),
+             StreamName="test-stream")
+    ]
+
+
 def test_kinesis_backend_resumes_sequences(kinesis_client):
     checkpointer_mock = MagicMock(spec=Checkpointer)  # type: Checkpointer
 
@@ -84,6 +113,456 @@ def test_kinesis_backend_resumes_sequences(kinesis_client):
     ]
 
 
+def test_kinesis_backend_read_batches(mocker, kinesis_client):
+    checkpointer_mock = MagicMock(spec=Checkpointer)  # type: Checkpointer
+    checkpointer_mock.get_checkpoint.return_value = None
+    mocker.patch(streams.__name__ + ".time")
+
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=checkpointer_mock,
+        kinesis_client=kinesis_client)
+    generator = kinesis_backend.read_batches()
+
+    records = next(generator)
+    assert [record.sequence_number for record in records] == ["sequence1", "sequence2", "sequence3"]
+    assert checkpointer_mock.checkpoint.mock_calls == []
+
+    next(generator)
+    assert checkpointer_mock.checkpoint.mock_calls == [call("shard1", "sequence3")]
+    generator.close()
+    assert checkpointer_mock.flush.mock_calls == [call()]
+
+
+def test_record_filter():
+    record = {"SequenceNumber": "sequence1", "PartitionKey": "user-1", "Data": b'{"type": "click"}',
+              "ApproximateArrivalTimestamp": datetime(2017, 1, 1)}
+
+    assert streams.RecordFilter()(record)
+    assert streams.RecordFilter(partition_keys=["user-1", "user-2"])(record)
+    assert not streams.RecordFilter(partition_keys=["user-2"])(record)
+    assert streams.RecordFilter(partition_key_prefix="user-")(record)
+    assert not streams.RecordFilter(min_arrival_timestamp=datetime(2017, 1, 2))(record)
+    assert streams.RecordFilter(data_prefix=b'{"type"')(record)
+    assert not streams.RecordFilter(data_regex=b'"type": "view"')(record)
+    assert streams.RecordFilter(sample_rate=1)(record)
+    assert not streams.RecordFilter(sample_rate=0)(record)
+
+
+def test_record_filter_samples_by_sequence_number():
+    records = [{"SequenceNumber": str(sequence), "Data": b""} for sequence in range(1000)]
+    record_filter = streams.RecordFilter(sample_rate=0.25)
+
+    selected = [record for record in records if record_filter(record)]
+
+    assert 150 < len(selected) < 350
+    assert selected == [record for record in records if record_filter(record)]
+
+
+def test_kinesis_backend_read_filtered_records(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer = InMemoryCheckpointer()
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=checkpointer,
+        kinesis_client=kinesis_client)
+    responses = [kinesis_client.get_records.return_value]
+
+    def get_records(**kwargs):
+        if not responses:
+            kinesis_backend.stop()
+            return {"Records": [], "NextShardIterator": "iterator3"}
+        return responses.pop()
+
+    kinesis_client.get_records.side_effect = get_records
+    generator = kinesis_backend.read(record_filter=lambda record: record["SequenceNumber"] == "sequence2")
+
+    assert [record.sequence_number for record in generator] == ["sequence2"]
+    assert checkpointer.get_checkpoint("shard1") == "sequence3"
+
+
+def test_kinesis_backend_read_batches_checkpoints_filtered_batches(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer_mock = MagicMock(spec=Checkpointer)  # type: Checkpointer
+    checkpointer_mock.get_checkpoint.return_value = None
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=checkpointer_mock,
+        kinesis_client=kinesis_client)
+    responses = [
+        {"Records": [{"Data": b"{}", "SequenceNumber": "sequence4"}], "NextShardIterator": "iterator3"},
+        kinesis_client.get_records.return_value,
+    ]
+
+    def get_records(**kwargs):
+        if len(responses) == 1:
+            kinesis_backend.stop()
+        return responses.pop()
+
+    kinesis_client.get_records.side_effect = get_records
+    generator = kinesis_backend.read_batches(record_filter=streams.RecordFilter(data_prefix=b'{"_key"'))
+
+    assert [len(records) for records in generator] == [3]
+    assert checkpointer_mock.checkpoint.mock_calls == [call("shard1", "sequence3"), call("shard1", "sequence4")]
+
+
+def test_kinesis_backend_read_shard_batches_checkpoint_sequence(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=InMemoryCheckpointer(),
+        kinesis_client=kinesis_client)
+    responses = [
+        {"Records": [{"Data": b"{}", "SequenceNumber": "sequence4"}], "NextShardIterator": "iterator3"},
+        kinesis_client.get_records.return_value,
+    ]
+
+    def get_records(**kwargs):
+        if len(responses) == 1:
+            kinesis_backend.stop()
+        return responses.pop()
+
+    kinesis_client.get_records.side_effect = get_records
+    batches = kinesis_backend.read_shard_batches(record_filter=lambda record: record["SequenceNumber"] == "sequence1")
+
+    assert [(shard_id, [record.sequence_number for record in records], checkpoint_sequence)
+            for shard_id, records, checkpoint_sequence in batches] == [
+        ("shard1", ["sequence1"], "sequence3"),
+        ("shard1", [], "sequence4"),
+    ]
+    assert kinesis_backend.checkpointer.get_checkpoint("shard1") is None
+
+
+COLUMNAR_RAW_RECORDS = [
+    {"SequenceNumber": "sequence1", "PartitionKey": "a", "Data": b"one",
+     "ApproximateArrivalTimestamp": datetime(2017, 1, 1, 0, 0, 1)},
+    {"SequenceNumber": "sequence2", "PartitionKey": "b", "Data": b"",
+     "ApproximateArrivalTimestamp": datetime(2017, 1, 1, 0, 0, 2)},
+    {"SequenceNumber": "sequence3", "PartitionKey": "a", "Data": b"three",
+     "ApproximateArrivalTimestamp": datetime(2017, 1, 1, 0, 0, 3, 500000)},
+]
+
+
+def test_columnar_batch():
+    batch = streams.ColumnarBatch.from_raw_records(COLUMNAR_RAW_RECORDS)
+
+    assert batch.data == b"onethree"
+    assert struct.unpack("<4q", batch.offsets) == (0, 3, 3, 8)
+    assert struct.unpack("<3q", batch.arrival_timestamps) == (1483228801000, 1483228802000, 1483228803500)
+    assert batch.sequence_numbers == ["sequence1", "sequence2", "sequence3"]
+    assert batch.partition_keys == ["a", "b", "a"]
+    assert len(batch) == 3
+    assert batch[-1].data == b"three"
+    assert batch[-1].approximate_arrival_timestamp == datetime(2017, 1, 1, 0, 0, 3, 500000)
+    assert [record.sequence_number for record in batch] == batch.sequence_numbers
+
+
+def test_columnar_batch_filter():
+    batch = streams.ColumnarBatch.from_raw_records(COLUMNAR_RAW_RECORDS, streams.RecordFilter(partition_keys=["a"]))
+
+    assert batch.data == b"onethree"
+    assert struct.unpack("<3q", batch.offsets) == (0, 3, 8)
+    assert batch.sequence_numbers == ["sequence1", "sequence3"]
+
+
+@numpy_only
+def test_columnar_batch_to_numpy():
+    import numpy
+
+    columns = streams.ColumnarBatch.from_raw_records(COLUMNAR_RAW_RECORDS).to_numpy()
+
+    assert columns["data"].tobytes() == b"onethree"
+    assert columns["offsets"].tolist() == [0, 3, 3, 8]
+    assert columns["arrival_timestamps"][2] == numpy.datetime64("2017-01-01T00:00:03.500")
+    assert columns["partition_keys"].tolist() == ["a", "b", "a"]
+
+
+@pyarrow_only
+def test_columnar_batch_to_arrow():
+    arrow_batch = streams.ColumnarBatch.from_raw_records(COLUMNAR_RAW_RECORDS).to_arrow()
+
+    assert arrow_batch.num_rows == 3
+    assert arrow_batch.column(0).to_pylist() == [b"one", b"", b"three"]
+    assert arrow_batch.column(2).to_pylist() == ["sequence1", "sequence2", "sequence3"]
+    assert arrow_batch.column(1)[0].value == 1483228801000
+
+
+def test_kinesis_backend_read_columnar_batches(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer = InMemoryCheckpointer()
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=checkpointer,
+        kinesis_client=kinesis_client)
+    generator = kinesis_backend.read_columnar_batches()
+
+    batch = next(generator)
+    assert batch.sequence_numbers == ["sequence1", "sequence2", "sequence3"]
+    assert batch.data == b"".join(record["Data"] for record in kinesis_client.get_records.return_value["Records"])
+
+    next(generator)
+    assert checkpointer.get_checkpoint("shard1") == "sequence3"
+
+
+def test_adaptive_batch_size():
+    batch_size = streams.AdaptiveBatchSize(target_bytes=1000, max_bytes=10000, initial_limit=50)
+    assert batch_size.limit("shard1") == 50
+
+    batch_size.observe("shard1", [{"Data": b"x" * 10}] * 50, latency=0.1)
+    assert batch_size.limit("shard1") == 100
+
+    batch_size.observe("shard1", [{"Data": b"x" * 10}] * 99 + [{"Data": b"x" * 1000}], latency=0.1)
+    assert batch_size.limit("shard1") == 10
+
+    batch_size.throttled("shard2")
+    assert batch_size.limit("shard2") == 25
+    assert batch_size.stats()["shard1"]["largest_record_size"] == 1000
+
+
+def test_adaptive_batch_size_slow_calls():
+    batch_size = streams.AdaptiveBatchSize(target_bytes=1000, max_latency=1)
+    batch_size.observe("shard1", [{"Data": b"x" * 10}], latency=0.1)
+    assert batch_size.limit("shard1") == 100
+
+    batch_size.observe("shard1", [{"Data": b"x" * 10}], latency=2)
+    assert batch_size.limit("shard1") == 75
+
+    batch_size.observe("shard1", [{"Data": b"x" * 10}], latency=0.1)
+    assert batch_size.limit("shard1") == 93
+
+
+def test_kinesis_backend_adaptive_batch_size(kinesis_client):
+    batch_size = streams.AdaptiveBatchSize(initial_limit=20)
+    kinesis_client.get_records.side_effect = [
+        ClientError(error_response={"Error": {"Code": "ProvisionedThroughputExceededException"}},
+                    operation_name="GetRecords"),
+        kinesis_client.get_records.return_value,
+    ]
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        batch_size=batch_size,
+        read_interval=0,
+        kinesis_client=kinesis_client)
+
+    assert next(kinesis_backend.read()).sequence_number == "sequence1"
+    assert kinesis_client.get_records.mock_calls == [
+        call(ShardIterator="iterator1", Limit=20),
+        call(ShardIterator="iterator1", Limit=10),
+    ]
+    assert batch_size.stats()["shard1"]["factor"] == 0.625
+
+
+def test_kinesis_backend_operation_timeouts(mocker, kinesis_client):
+    client_mock = mocker.patch("boto3.client", return_value=kinesis_client)
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        read_timeout=30,
+        operation_timeouts={"get_records": (1, 5)})
+
+    kinesis_backend.put(key="123", data=b"some bytes")
+    next(kinesis_backend.read())
+
+    configs = [client_call[1]["config"] for client_call in client_mock.call_args_list]
+    assert [(config.connect_timeout, config.read_timeout) for config in configs] == [(60, 30), (1, 5)]
+    assert all(config.tcp_keepalive for config in configs)
+    assert set(kinesis_backend.latencies.stats()) == {"put_record", "get_records"}
+
+
+def test_kinesis_client_without_tcp_keepalive_support(mocker):
+    from botocore.config import Config
+
+    client_mock = mocker.patch("boto3.client")
+    option_defaults = dict(Config.OPTION_DEFAULTS)
+    option_defaults.pop("tcp_keepalive", None)
+    mocker.patch.object(Config, "OPTION_DEFAULTS", option_defaults)
+
+    streams.get_kinesis_client("us-east-1")
+    streams.get_kinesis_client("eu-west-1", read_timeout=10)
+
+    configs = [client_call[1]["config"] for client_call in client_mock.call_args_list]
+    assert [config.read_timeout for config in configs] == [60, 10]
+    assert not any(getattr(config, "tcp_keepalive", None) for config in configs)
+
+
+def test_latency_tracker():
+    tracker = streams.LatencyTracker(window=100)
+    for latency in range(200):
+        tracker.record("get_records", latency / 1000.0)
+
+    assert tracker.percentile("get_records", 50) == 0.15
+    assert tracker.percentile("get_records", 99) == 0.199
+    assert tracker.percentile("get_records", 99, min_samples=101) is None
+    assert tracker.percentile("put_records", 99) is None
+    assert tracker.stats()["get_records"]["calls"] == 100
+
+
+def test_kinesis_backend_hedges_slow_get_records(kinesis_client):
+    records_response = kinesis_client.get_records.return_value
+    released = Event()
+
+    def get_records(**kwargs):
+        if kinesis_client.get_records.call_count == 1:
+            released.wait(5)
+        return records_response
+
+    kinesis_client.get_records.side_effect = get_records
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        hedge_get_records=True,
+        kinesis_client=kinesis_client)
+    for _ in range(kinesis_backend.HEDGE_MIN_SAMPLES):
+        kinesis_backend.latencies.record("get_records", 0.01)
+
+    try:
+        assert next(kinesis_backend.read()).sequence_number == "sequence1"
+        assert kinesis_client.get_records.mock_calls == [call(ShardIterator="iterator1", Limit=10000)] * 2
+    finally:
+        released.set()
+
+
+def test_kinesis_backend_max_age(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    now = datetime.utcnow()
+    kinesis_client.get_records.return_value = {
+        "Records": [
+            {"Data": b"1", "SequenceNumber": "sequence1", "ApproximateArrivalTimestamp": now - timedelta(hours=2)},
+            {"Data": b"2", "SequenceNumber": "sequence2",
+             "ApproximateArrivalTimestamp": (now - timedelta(seconds=10)).replace(tzinfo=tzutc())},
+            {"Data": b"3", "SequenceNumber": "sequence3",
+             "ApproximateArrivalTimestamp": (now - timedelta(hours=1)).replace(tzinfo=tzutc())},
+        ],
+        "NextShardIterator": "iterator2",
+        "MillisBehindLatest": 0,
+    }
+    checkpointer = InMemoryCheckpointer()
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        checkpointer=checkpointer,
+        max_age=timedelta(minutes=5),
+        kinesis_client=kinesis_client)
+    generator = kinesis_backend.read()
+
+    assert next(generator).data == b"2"
+    assert kinesis_backend.stale_records == 2
+    kinesis_backend.stop()
+    next(generator, None)
+    assert checkpointer.get_checkpoint("shard1") == "sequence3"
+    assert len(kinesis_client.get_shard_iterator.mock_calls) == 1
+
+
+def test_kinesis_backend_max_age_skips_ahead(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_client.get_records.return_value["MillisBehindLatest"] = 3600 * 1000
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        max_age=60,
+        kinesis_client=kinesis_client)
+    generator = kinesis_backend.read_batches()
+
+    next(generator, None)
+    kinesis_backend.stop()
+    next(generator, None)
+
+    skip_call = kinesis_client.get_shard_iterator.mock_calls[1]
+    assert skip_call[2]["ShardIteratorType"] == "AT_TIMESTAMP"
+    assert datetime.utcnow() - skip_call[2]["Timestamp"] < timedelta(seconds=65)
+    assert kinesis_backend.stale_records == 0
+
+
+def test_kinesis_backend_refreshes_expired_iterators(kinesis_client):
+    records_response = kinesis_client.get_records.return_value
+    kinesis_client.get_records.side_effect = [
+        records_response,
+        ClientError(error_response={"Error": {"Code": "ExpiredIteratorException"}}, operation_name="GetRecords"),
+        records_response,
+    ]
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        read_interval=0,
+        kinesis_client=kinesis_client)
+    generator = kinesis_backend.read_batches()
+    next(generator)
+    next(generator)
+
+    assert kinesis_client.get_shard_iterator.mock_calls == [
+        call(ShardId="shard1", ShardIteratorType="TRIM_HORIZON", StreamName="test-streams"),
+        call(ShardId="shard1", ShardIteratorType="AFTER_SEQUENCE_NUMBER", StartingSequenceNumber="sequence3",
+             StreamName="test-streams"),
+    ]
+    assert kinesis_client.get_records.mock_calls[1:] == [
+        call(ShardIterator="iterator2", Limit=10000),
+        call(ShardIterator="iterator1", Limit=10000),
+    ]
+
+
+def test_shard_iterators_refresh_old_iterators(mocker, kinesis_client):
+    datetime_mock = mocker.patch(streams.__name__ + ".datetime")
+    datetime_mock.now.return_value = datetime(2017, 1, 1)
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        kinesis_client=kinesis_client)
+    shard_iterators = streams.ShardIterators(kinesis_backend)
+    shard_iterators.update()
+    shard_iterators.get_records("shard1")
+
+    datetime_mock.now.return_value += timedelta(seconds=streams.ShardIterators.ITERATOR_MAX_AGE + 1)
+    shard_iterators.get_records("shard1")
+
+    assert kinesis_client.get_shard_iterator.mock_calls[1] == call(
+        ShardId="shard1", ShardIteratorType="AFTER_SEQUENCE_NUMBER", StartingSequenceNumber="sequence3",
+        StreamName="test-streams")
+    assert kinesis_client.get_records.mock_calls == [
+        call(ShardIterator="iterator1", Limit=10000),
+        call(ShardIterator="iterator1", Limit=10000),
+    ]
+
+
+def test_shard_iterators_refresh_throttled_iterators(mocker, kinesis_client):
+    datetime_mock = mocker.patch(streams.__name__ + ".datetime")
+    datetime_mock.now.return_value = datetime(2017, 1, 1)
+    kinesis_client.get_records.side_effect = ClientError(
+        error_response={"Error": {"Code": "ProvisionedThroughputExceededException"}}, operation_name="GetRecords")
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        batch_size=streams.AdaptiveBatchSize(),
+        kinesis_client=kinesis_client)
+    shard_iterators = streams.ShardIterators(kinesis_backend)
+    shard_iterators.update()
+
+    for _ in range(4):
+        assert shard_iterators.get_records("shard1") == []
+        datetime_mock.now.return_value += timedelta(seconds=streams.ShardIterators.ITERATOR_MAX_AGE / 2)
+
+    assert len(kinesis_client.get_shard_iterator.mock_calls) == 2
+
+
+def test_shard_iterators_skip_closed_shards(kinesis_client):
+    kinesis_client.get_records.return_value = {"Records": [], "NextShardIterator": None}
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        kinesis_client=kinesis_client)
+    shard_iterators = streams.ShardIterators(kinesis_backend)
+    shard_iterators.update()
+    shard_iterators.get_records("shard1")
+    shard_iterators.update()
+
+    assert shard_iterators.shard_ids() == []
+
+
 def test_kinesis_backend_put(kinesis_client):
     kinesis_backend = streams.KinesisStream(
         stream_name="test-streams",
@@ -96,6 +575,24 @@ def test_kinesis_backend_put(kinesis_client):
         call(Data=b"some bytes", PartitionKey="123", StreamName="test-streams")]
 
 
+def test_kinesis_backend_put_records(kinesis_client):
+    kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-streams",
+        region_name="us-east-1",
+        kinesis_client=kinesis_client)
+    kinesis_backend.PUT_RECORDS_MAX_COUNT = 2
+
+    failed = kinesis_backend.put_records([("1", b"one"), ("2", b"two"), ("3", b"three")])
+
+    assert failed == []
+    assert kinesis_client.put_records.mock_calls == [
+        call(StreamName="test-streams", Records=[{"Data": b"one", "PartitionKey": "1"},
+                                                 {"Data": b"two", "PartitionKey": "2"}]),
+        call(StreamName="test-streams", Records=[{"Data": b"three", "PartitionKey": "3"}]),
+    ]
+
+
 def test_kinesis_custom_exception_on_read(failing_kinesis_client):
     kinesis_backend = streams.KinesisStream(
         stream_name="test-stream",
@@ -108,3 +605,137 @@ def test_kinesis_custom_exception_on_read(failing_kinesis_client):
 
     with pytest.raises(streams.StreamReadingException):
         next(generator)
+
+
+def test_fan_out_kinesis_backend(mocker, fan_out_kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer = InMemoryCheckpointer()
+    kinesis_backend = streams.EnhancedFanOutKinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        consumer_name="my-app",
+        checkpointer=checkpointer,
+        kinesis_client=fan_out_kinesis_client,
+    )
+    generator = kinesis_backend.read()
+
+    assert next(generator).data == b'{"_key": "1", "message": "message1"}'
+    assert next(generator).data == b'{"_key": "2", "message": "message2"}'
+    assert next(generator).data == b'{"_key": "3", "message": "message3"}'
+    assert kinesis_backend.is_shard_closed("shard1")
+    kinesis_backend.stop()
+    with pytest.raises(StopIteration):
+        next(generator)
+
+    assert checkpointer.get_checkpoint("shard1") == "sequence3"
+    assert fan_out_kinesis_client.register_stream_consumer.mock_calls == [
+        call(StreamARN="arn:stream", ConsumerName="my-app")]
+    assert fan_out_kinesis_client.subscribe_to_shard.mock_calls == [
+        call(ConsumerARN="arn:consumer", ShardId="shard1", StartingPosition={"Type": "TRIM_HORIZON"}),
+        call(ConsumerARN="arn:consumer", ShardId="shard1",
+             StartingPosition={"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": "continuation2"}),
+    ]
+
+
+def test_fan_out_kinesis_backend_resumes_from_checkpoint(mocker, fan_out_kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    checkpointer = InMemoryCheckpointer()
+    checkpointer.checkpoint("shard1", "sequence0")
+    reading_threads = set()
+    get_checkpoint = checkpointer.get_checkpoint
+    mocker.patch.object(checkpointer, "get_checkpoint",
+                        side_effect=lambda shard_id: reading_threads.add(current_thread()) or get_checkpoint(shard_id))
+    kinesis_backend = streams.EnhancedFanOutKinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        consumer_name="my-app",
+        checkpointer=checkpointer,
+        kinesis_client=fan_out_kinesis_client,
+    )
+    generator = kinesis_backend.read()
+    next(generator)
+    kinesis_backend.stop()
+
+    assert fan_out_kinesis_client.subscribe_to_shard.mock_calls[0] == call(
+        ConsumerARN="arn:consumer", ShardId="shard1",
+        StartingPosition={"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": "sequence0"})
+    assert reading_threads == {current_thread()}
+
+
+def test_fan_out_kinesis_backend_at_timestamp(mocker, fan_out_kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_backend = streams.EnhancedFanOutKinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        consumer_name="my-app",
+        iterator_type="AT_TIMESTAMP",
+        iterator_timestamp=datetime(2017, 1, 1),
+        kinesis_client=fan_out_kinesis_client,
+    )
+    generator = kinesis_backend.read()
+    next(generator)
+    kinesis_backend.stop()
+
+    assert fan_out_kinesis_client.subscribe_to_shard.mock_calls[0] == call(
+        ConsumerARN="arn:consumer", ShardId="shard1",
+        StartingPosition={"Type": "AT_TIMESTAMP", "Timestamp": datetime(2017, 1, 1)})
+
+
+def test_fan_out_kinesis_backend_retires_subscriptions(mocker, fan_out_kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_backend = streams.EnhancedFanOutKinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        consumer_name="my-app",
+        kinesis_client=fan_out_kinesis_client,
+    )
+    generator = kinesis_backend.read()
+    next(generator)
+    subscriptions = list(kinesis_backend._subscriptions.values())
+    events = kinesis_backend._events
+    generator.close()
+
+    for thread in subscriptions:
+        thread.join(5)
+        assert not thread.is_alive()
+    fan_out_kinesis_client.subscribe_to_shard.side_effect = None
+    fan_out_kinesis_client.subscribe_to_shard.return_value = {"EventStream": [
+        {"SubscribeToShardEvent": {"Records": [{"Data": b"new", "SequenceNumber": "sequence4"}]}}]}
+
+    assert next(kinesis_backend.read()).data == b"new"
+    assert kinesis_backend._events is not events
+
+
+def test_fan_out_kinesis_backend_releases_subscriptions(mocker, fan_out_kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    mocker.patch.object(streams.EnhancedFanOutKinesisStream, "SUBSCRIBE_RETRY_INTERVAL", 0)
+
+    def heartbeats():
+        yield {"SubscribeToShardEvent": {"Records": [{"Data": b"old", "SequenceNumber": "sequence1"}],
+                                         "ContinuationSequenceNumber": "sequence1"}}
+        while True:
+            Event().wait(0.01)
+            yield {"SubscribeToShardEvent": {"Records": [], "ContinuationSequenceNumber": "sequence1"}}
+    event_stream = MagicMock()
+    event_stream.__iter__.return_value = heartbeats()
+    fan_out_kinesis_client.subscribe_to_shard.side_effect = [
+        {"EventStream": event_stream},
+        ClientError(error_response={"Error": {"Code": "ResourceInUseException"}}, operation_name="SubscribeToShard"),
+        {"EventStream": [{"SubscribeToShardEvent": {"Records": [{"Data": b"new", "SequenceNumber": "sequence2"}]}}]},
+    ]
+    kinesis_backend = streams.EnhancedFanOutKinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        consumer_name="my-app",
+        kinesis_client=fan_out_kinesis_client,
+    )
+    generator = kinesis_backend.read()
+    assert next(generator).data == b"old"
+    subscriptions = list(kinesis_backend._subscriptions.values())
+    generator.close()
+
+    for thread in subscriptions:
+        thread.join(5)
+    event_stream.close.assert_called_once_with()
+    assert next(kinesis_backend.read()).data == b"new"
+    assert fan_out_kinesis_client.subscribe_to_shard.call_count >= 3
@@ -0,0 +1,68 @@
+from mock import MagicMock
+
+from pynesis import streams, tracing
+from pynesis.tests.conftest import opentelemetry_only
+
+
+def test_callback_tracer(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    on_start = MagicMock(side_effect=lambda name, attributes: (name, attributes.get("shard_id")))
+    on_end = MagicMock()
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        kinesis_client=kinesis_client,
+        tracer=tracing.CallbackTracer(on_start, on_end),
+    )
+    generator = kinesis_backend.read()
+    next(generator)
+    next(generator)
+
+    started = [name for name, attributes in (call[0] for call in on_start.call_args_list)]
+    ended = [call[0][0] for call in on_end.call_args_list]
+    assert started == ["update_shard_iterators", "get_records", "build_records", "handler", "checkpoint", "handler"]
+    assert ended == [("update_shard_iterators", None), ("get_records", "shard1"), ("build_records", "shard1"),
+                     ("handler", "shard1"), ("checkpoint", "shard1")]
+    assert on_start.call_args_list[1][0][1] == {"stream": "test-stream", "shard_id": "shard1", "limit": 10000}
+
+
+def test_profiling_tracer(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    output = MagicMock()
+    profiler = tracing.ProfilingTracer(report_interval=0, output=output)
+    kinesis_backend = streams.KinesisStream(
+        stream_name="test-stream",
+        region_name="us-east-1",
+        kinesis_client=kinesis_client,
+        tracer=profiler,
+    )
+    generator = kinesis_backend.read()
+    for _ in range(4):
+        next(generator)
+
+    report = profiler.report().split("\n")
+    stages = set(tuple(line.split()[:3]) for line in report[1:] if line)
+    assert ("shard1", "handler", "3") in stages
+    assert ("shard1", "checkpoint", "3") in stages
+    assert ("shard1", "get_records", "2") in stages
+    assert ("-", "sleep", "1") in stages
+    assert output.write.called
+
+
+@opentelemetry_only
+def test_opentelemetry_tracer():
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracer = tracing.OpenTelemetryTracer(tracer_provider=tracer_provider)
+
+    with tracer.span("get_records", stream="test-stream", shard_id="shard1"):
+        pass
+
+    spans = exporter.get_finished_spans()
+    assert [span.name for span in spans] == ["pynesis.get_records"]
+    assert dict(spans[0].attributes) == {"pynesis.stream": "test-stream", "pynesis.shard_id": "shard1"}
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import pytest
+from mock import MagicMock, call
+
+from pynesis import streams
+from pynesis.checkpointers import Checkpointer
+from pynesis.windows import SlidingWindow, TumblingWindow
+
+
+def build_record(sequence, seconds, key, value=1):
+    return {"SequenceNumber": sequence, "PartitionKey": key, "Data": str(value).encode("utf-8"),
+            "ApproximateArrivalTimestamp": datetime(2017, 1, 1) + timedelta(seconds=seconds)}
+
+
+@pytest.fixture
+def windowed_stream(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    responses = [{"Records": [build_record("sequence1", 0, "a"),
+                              build_record("sequence2", 10, "a", 2),
+                              build_record("sequence3", 65, "b")],
+                  "NextShardIterator": "iterator2"}]
+    kinesis_client.get_records.side_effect = lambda **kwargs: (
+        responses.pop() if responses else {"Records": [], "NextShardIterator": "iterator2"})
+    checkpointer_mock = MagicMock(spec=Checkpointer)
+    checkpointer_mock.get_checkpoint.return_value = None
+    return streams.KinesisStream(stream_name="test-stream", region_name="us-east-1",
+                                 kinesis_client=kinesis_client, checkpointer=checkpointer_mock)
+
+
+def test_tumbling_window(windowed_stream):
+    window = TumblingWindow(timedelta(minutes=1))
+    generator = window.read(windowed_stream)
+
+    results = next(generator)
+    assert [(result.key, result.start, result.end, result.value) for result in results] == [
+        ("a", datetime(2017, 1, 1), datetime(2017, 1, 1, 0, 1), 2)]
+    assert windowed_stream.checkpointer.checkpoint.mock_calls == []
+
+    windowed_stream.stop()
+    with pytest.raises(StopIteration):
+        next(generator)
+    # The window of "b" is still open, sequence3 is left to be read again
+    assert windowed_stream.checkpointer.checkpoint.mock_calls == [call("shard1", "sequence2")]
+    windowed_stream.checkpointer.flush.assert_called_with()
+
+
+def test_sliding_window(windowed_stream):
+    window = SlidingWindow(size=60, slide=30, key=lambda record: "all",
+                           aggregate=lambda value, record: value + int(record.data))
+    results = []
+    for window_results in window.read(windowed_stream):
+        results.extend((result.start, result.value) for result in window_results)
+        windowed_stream.stop()
+
+    assert results == [
+        (datetime(2016, 12, 31, 23, 59, 30), 3),
+        (datetime(2017, 1, 1), 3),
+    ]
+
+
+def test_window_checkpoints_discarded_records(windowed_stream):
+    def read_shard_batches():
+        yield "shard1", [streams.KinesisRecord(build_record("sequence1", 0, "a"))], "sequence2"
+        yield "shard1", [streams.KinesisRecord(build_record("sequence3", 65, "b"))], "sequence4"
+    windowed_stream.read_shard_batches = read_shard_batches
+
+    results = list(TumblingWindow(60).read(windowed_stream))
+
+    assert [(result.key, result.value) for window_results in results for result in window_results] == [("a", 1)]
+    assert windowed_stream.checkpointer.checkpoint.mock_calls == [call("shard1", "sequence2")]
+
+
+def test_window_after_reshard(mocker, kinesis_client):
+    mocker.patch(streams.__name__ + ".time")
+    kinesis_client.get_paginator.return_value.paginate.side_effect = None
+    kinesis_client.get_paginator.return_value.paginate.return_value = [
+        {"StreamDescription": {"Shards": [{"ShardId": "parent"}, {"ShardId": "child"}]}}]
+    kinesis_client.get_shard_iterator.side_effect = lambda **kwargs: {"ShardIterator": kwargs["ShardId"]}
+    child_records = [build_record("child{}".format(i), 60 * i + 30, "a") for i in range(1, 11)]
+
+    def get_records(ShardIterator, Limit):
+        if ShardIterator == "parent":
+            return {"Records": [build_record("parent1", 30, "a")], "NextShardIterator": None}
+        if not child_records:
+            stream.stop()
+            return {"Records": [], "NextShardIterator": "child"}
+        return {"Records": [child_records.pop(0)], "NextShardIterator": "child"}
+    kinesis_client.get_records.side_effect = get_records
+    checkpointer_mock = MagicMock(spec=Checkpointer)
+    checkpointer_mock.get_checkpoint.return_value = None
+    stream = streams.KinesisStream(stream_name="test-stream", region_name="us-east-1",
+                                   kinesis_client=kinesis_client, checkpointer=checkpointer_mock)
+
+    results = [result for window_results in TumblingWindow(60).read(stream) for result in window_results]
+
+    assert [(result.start, result.value) for result in results][:10] == [
+        (datetime(2017, 1, 1) + timedelta(minutes=i), 1) for i in range(10)]
+    assert call("parent", "parent1") in checkpointer_mock.checkpoint.mock_calls
+    assert call("child", "child9") in checkpointer_mock.checkpoint.mock_calls
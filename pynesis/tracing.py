@@ -0,0 +1,142 @@
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, IO, List, Optional, Tuple  # noqa
+
+
+class _Span(object):
+    __slots__ = ("_tracer", "_name", "_attributes", "_token")
+
+    def __init__(self, tracer, name, attributes):  # type: (Tracer, str, Dict[str, Any]) -> None
+        self._tracer = tracer
+        self._name = name
+        self._attributes = attributes
+        self._token = None  # type: Any
+
+    def __enter__(self):  # type: () -> None
+        self._token = self._tracer.start_span(self._name, self._attributes)
+
+    def __exit__(self, *exc_info):  # type: (*Any) -> None
+        self._tracer.end_span(self._token)
+
+
+class Tracer(object):
+    """
+    Tracer receives the start and end of each stage of the reading of a stream, such as:
+
+     - "update_shard_iterators": Discovering shards and getting iterators for the new ones
+     - "get_records": A GetRecords call
+     - "build_records": Building the KinesisRecord instances from a GetRecords response
+     - "handler": The time spent by the caller of read() (or read_batches()) with the records yielded
+     - "checkpoint", "flush": Checkpointer calls
+     - "sleep": Waiting `read_interval` seconds between rounds
+
+    Attributes include the "stream" name and, where it applies, the "shard_id" (and the "limit" of GetRecords calls).
+
+    The base implementation does nothing.
+    """
+    def span(self, name, **attributes):  # type: (str, **Any) -> _Span
+        """
+        Returns a context manager tracing the block it wraps as a span
+        """
+        return _Span(self, name, attributes)
+
+    def start_span(self, name, attributes):  # type: (str, Dict[str, Any]) -> Any
+        """
+        Called when a stage starts, the returned value will be given to end_span()
+        """
+
+    def end_span(self, token):  # type: (Any) -> None
+        """
+        Called when a stage ends, with the value returned by start_span()
+        """
+
+
+class CallbackTracer(Tracer):
+    """
+    Tracer calling the given callbacks, `on_start(name, attributes)` and `on_end(token)`, where
+    `token` is whatever `on_start` returned
+    """
+    def __init__(self,
+                 on_start,  # type: Callable[[str, Dict[str, Any]], Any]
+                 on_end,  # type: Callable[[Any], None]
+                 ):  # type: (...) -> None
+        self._on_start = on_start
+        self._on_end = on_end
+
+    def start_span(self, name, attributes):  # type: (str, Dict[str, Any]) -> Any
+        return self._on_start(name, attributes)
+
+    def end_span(self, token):  # type: (Any) -> None
+        self._on_end(token)
+
+
+class OpenTelemetryTracer(Tracer):
+    """
+    Tracer creating an OpenTelemetry span, named "pynesis.<stage>", for each stage.
+    Requires the opentelemetry-api package.
+    """
+    def __init__(self, tracer_provider=None):  # type: (Any) -> None
+        from opentelemetry import trace
+
+        self._tracer = trace.get_tracer("pynesis", tracer_provider=tracer_provider)
+
+    def start_span(self, name, attributes):  # type: (str, Dict[str, Any]) -> Any
+        return self._tracer.start_span("pynesis." + name, attributes={
+            "pynesis." + key: value for key, value in attributes.items() if value is not None})
+
+    def end_span(self, token):  # type: (Any) -> None
+        token.end()
+
+
+class ProfilingTracer(Tracer):
+    """
+    Tracer measuring where the time goes for each shard.
+
+    Only a `sample_rate` fraction of the spans is measured, which is enough to estimate the share of
+    time of each stage while keeping the overhead low. The breakdown is written to `output` every
+    `report_interval` seconds (if given), and can be obtained at any time with report().
+    """
+    def __init__(self,
+                 sample_rate=1.0,  # type: float
+                 report_interval=None,  # type: float
+                 output=None,  # type: IO[str]
+                 ):  # type: (...) -> None
+        self._sample_rate = sample_rate
+        self._report_interval = report_interval
+        self._output = output
+        self._last_report = time.time()
+        self._durations = defaultdict(float)  # type: Dict[Tuple[str, str], float]
+        self._counts = defaultdict(int)  # type: Dict[Tuple[str, str], int]
+
+    def start_span(self, name, attributes):  # type: (str, Dict[str, Any]) -> Any
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return None
+        return name, attributes.get("shard_id") or "-", time.time()
+
+    def end_span(self, token):  # type: (Any) -> None
+        if token is None:
+            return
+        name, shard_id, start_time = token
+        now = time.time()
+        self._durations[(shard_id, name)] += now - start_time
+        self._counts[(shard_id, name)] += 1
+
+        if self._report_interval is not None and now - self._last_report >= self._report_interval:
+            self._last_report = now
+            (self._output or sys.stderr).write(self.report())
+
+    def report(self):  # type: () -> str
+        """
+        Returns a table with the sampled spans count, time and share of time of each stage by shard
+        """
+        lines = ["{:<24} {:<24} {:>10} {:>12} {:>7}".format("shard", "stage", "spans", "seconds", "%")]
+        for shard_id in sorted(set(shard_id for shard_id, name in self._durations)):
+            stages = [(name, duration) for (stage_shard_id, name), duration in self._durations.items()
+                      if stage_shard_id == shard_id]
+            total = sum(duration for name, duration in stages) or 1
+            for name, duration in sorted(stages, key=lambda stage: -stage[1]):
+                lines.append("{:<24} {:<24} {:>10} {:>12.3f} {:>7.1f}".format(
+                    shard_id, name, self._counts[(shard_id, name)], duration, 100 * duration / total))
+        return "\n".join(lines) + "\n"
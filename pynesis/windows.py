@@ -0,0 +1,169 @@
+import calendar
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Set, Tuple, Union  # noqa
+
+from pynesis.streams import KinesisRecord, KinesisStream  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+def _to_seconds(value):  # type: (Union[timedelta, float]) -> float
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def _timestamp(record):  # type: (KinesisRecord) -> float
+    arrival = record.approximate_arrival_timestamp
+    return calendar.timegm(arrival.utctimetuple()) + arrival.microsecond / 1e6
+
+
+def _partition_key(record):  # type: (KinesisRecord) -> str
+    return record.partition_key
+
+
+def _count(value, record):  # type: (int, KinesisRecord) -> int
+    return value + 1
+
+
+class WindowResult(object):
+    def __init__(self, key, start, end, value):  # type: (Any, datetime, datetime, Any) -> None
+        self.key = key
+        self.start = start
+        self.end = end
+        self.value = value
+
+    def __repr__(self):
+        return "WindowResult(key={!r}, start={}, end={}, value={!r})".format(
+            self.key, self.start, self.end, self.value)
+
+
+class SlidingWindow(object):
+    """
+    Aggregates the records of a KinesisStream by key over windows of `size` seconds (or a timedelta)
+    starting every `slide` seconds, based on the records approximate_arrival_timestamp.
+
+    For each window and key, the value starts as `initial()` and each record is added with
+    `aggregate(value, record)`, which by default counts the records. Records are grouped by partition
+    key unless a `key(record)` function is given.
+
+    read() yields the results of the windows once they close, which happens when the records of every
+    shard not yet caught up have arrived past the end of the window plus `allowed_lateness` seconds.
+    Records arriving after their windows have closed are dropped. Once the caller asks for the next results,
+    each shard is checkpointed up to the last record whose windows have all been yielded, so that no record
+    is lost if the process stops before the results are written. The windows still open when the stream
+    is stopped are dropped without being yielded, their records being read again once the stream is restarted.
+    """
+    def __init__(self,
+                 size,  # type: Union[timedelta, float]
+                 slide,  # type: Union[timedelta, float]
+                 key=None,  # type: Callable[[KinesisRecord], Any]
+                 aggregate=None,  # type: Callable[[Any, KinesisRecord], Any]
+                 initial=None,  # type: Callable[[], Any]
+                 allowed_lateness=0,  # type: Union[timedelta, float]
+                 ):  # type: (...) -> None
+        self._size = _to_seconds(size)
+        self._slide = _to_seconds(slide)
+        self._key = key if key is not None else _partition_key
+        self._aggregate = aggregate if aggregate is not None else _count
+        self._initial = initial if initial is not None else int
+        self._allowed_lateness = _to_seconds(allowed_lateness)
+        self._windows = {}  # type: Dict[float, Dict[Any, Any]]
+        self._shard_times = {}  # type: Dict[str, float]
+        self._idle_shards = set()  # type: Set[str]
+        self._pending = {}  # type: Dict[str, Deque[Tuple[float, str]]]
+        self._watermark = float("-inf")
+        self.late_records = 0
+
+    def read(self, stream):  # type: (KinesisStream) -> Generator[List[WindowResult], None, None]
+        """
+        Yields the results of the windows closed after each batch of records read from the stream
+        """
+        for shard_id, records, checkpoint_sequence in stream.read_shard_batches():
+            self._add(shard_id, records)
+            if stream.is_shard_closed(shard_id):
+                # Its child shards take over, so it must not hold the watermark back anymore
+                self._shard_times.pop(shard_id, None)
+                self._idle_shards.discard(shard_id)
+            if checkpoint_sequence is not None and (not records or records[-1].sequence_number != checkpoint_sequence):
+                # Records discarded by the stream (see KinesisStream.read_shard_batches), done with the ones before
+                self._pending.setdefault(shard_id, deque()).append((self._watermark, checkpoint_sequence))
+            results = self._close_windows(self._get_watermark())
+            if results:
+                yield results
+            self._checkpoint(stream)
+
+        # The windows still open are dropped, their records were not checkpointed and are read again next time
+        self._windows.clear()
+        self._pending.clear()
+        self._shard_times.clear()
+        self._idle_shards.clear()
+        stream.checkpointer.flush()
+
+    def _window_starts(self, timestamp):  # type: (float) -> List[float]
+        last_start = (timestamp // self._slide) * self._slide
+        starts = []
+        start = last_start
+        while start > timestamp - self._size:
+            starts.append(start)
+            start -= self._slide
+        return starts
+
+    def _add(self, shard_id, records):  # type: (str, List[KinesisRecord]) -> None
+        if not records:
+            self._idle_shards.add(shard_id)
+            return
+        self._idle_shards.discard(shard_id)
+
+        pending = self._pending.setdefault(shard_id, deque())
+        for record in records:
+            timestamp = _timestamp(record)
+            self._shard_times[shard_id] = max(self._shard_times.get(shard_id, timestamp), timestamp)
+            starts = [start for start in self._window_starts(timestamp) if start + self._size > self._watermark]
+            if not starts:
+                self.late_records += 1
+            key = self._key(record)
+            for start in starts:
+                window = self._windows.setdefault(start, {})
+                window[key] = self._aggregate(window[key] if key in window else self._initial(), record)
+            pending.append((max(starts) + self._size if starts else self._watermark, record.sequence_number))
+
+    def _get_watermark(self):  # type: () -> float
+        busy_times = [time for shard_id, time in self._shard_times.items() if shard_id not in self._idle_shards]
+        times = busy_times or list(self._shard_times.values())
+        if not times:
+            return self._watermark
+        return max(self._watermark, min(times) - self._allowed_lateness)
+
+    def _close_windows(self, watermark):  # type: (float) -> List[WindowResult]
+        self._watermark = watermark
+        results = []  # type: List[WindowResult]
+        for start in sorted(self._windows):
+            if start + self._size > watermark:
+                break
+            window_start = datetime.utcfromtimestamp(start)
+            window_end = window_start + timedelta(seconds=self._size)
+            for key, value in self._windows.pop(start).items():
+                results.append(WindowResult(key, window_start, window_end, value))
+        return results
+
+    def _checkpoint(self, stream):  # type: (KinesisStream) -> None
+        for shard_id, pending in self._pending.items():
+            sequence = None  # type: Optional[str]
+            while pending and pending[0][0] <= self._watermark:
+                sequence = pending.popleft()[1]
+            if sequence is not None:
+                stream.checkpointer.checkpoint(shard_id, sequence)
+
+
+class TumblingWindow(SlidingWindow):
+    """
+    Aggregates records over consecutive, non overlapping, windows of `size` seconds, see SlidingWindow
+    """
+    def __init__(self,
+                 size,  # type: Union[timedelta, float]
+                 **kwargs  # type: Any
+                 ):  # type: (...) -> None
+        super(TumblingWindow, self).__init__(size, size, **kwargs)